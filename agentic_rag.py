@@ -1,10 +1,22 @@
+import asyncio
+import dataclasses
+import functools
+import json
 import logging
+import operator
 import os
+import queue
 import re
 import sys
+import threading
+import time
 import warnings
-from typing import List
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait
+from typing import Annotated, List, Literal
 
+import numpy as np
 import requests
 import spacy
 import streamlit as st
@@ -14,12 +26,17 @@ from langchain.chains import RetrievalQA
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import FlashrankRerank
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import (UnstructuredMarkdownLoader,
+from langchain_community.document_loaders import (TextLoader,
+                                                  UnstructuredMarkdownLoader,
                                                   WebBaseLoader)
 from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_core.callbacks.manager import (adispatch_custom_event,
+                                              dispatch_custom_event)
 from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 from langchain_groq.chat_models import ChatGroq
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_ollama import ChatOllama, OllamaEmbeddings
@@ -29,17 +46,39 @@ from langgraph.graph import END, StateGraph
 from pydantic import BaseModel, Field
 from PyPDF2 import PdfReader
 from sentence_transformers import SentenceTransformer, util
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from typing_extensions import TypedDict
 
+import metrics
+from fake_backends import (FAKE_BACKENDS_ENABLED, FakeAsyncOpenAI,
+                           FakeChatModel, FakeOpenAI, HashEmbeddings,
+                           is_fake_model)
+from rag_cache import GradeCache, WebSearchCache
+
+
+def _secret(name):
+    """
+    API key from the Streamlit secrets, else from the environment. Offline
+    runs with fake backends (SMART_GUIDE_FAKE_BACKENDS=1) need neither.
+    """
+    try:
+        return st.secrets[name]
+    except (KeyError, FileNotFoundError):
+        if name in os.environ:
+            return os.environ[name]
+        if FAKE_BACKENDS_ENABLED:
+            return "offline"
+        raise
+
+
 # Set up environment variables
 # os.environ["LANGCHAIN_TRACING_V2"] = "true"
 # os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["USER_AGENT"] = "AgenticRAG/1.0"
-os.environ["TAVILY_API_KEY"] = st.secrets["TAVILY_API_KEY"]
-os.environ["GROQ_API_KEY"] = st.secrets["GROQ_API_KEY"]
-# os.environ["LANGCHAIN_API_KEY"] = st.secrets["LANGCHAIN_API_KEY"]
-os.environ["OPENAI_API_KEY"] = st.secrets["OPENAI_API_KEY"]
+os.environ["TAVILY_API_KEY"] = _secret("TAVILY_API_KEY")
+os.environ["GROQ_API_KEY"] = _secret("GROQ_API_KEY")
+# os.environ["LANGCHAIN_API_KEY"] = _secret("LANGCHAIN_API_KEY")
+os.environ["OPENAI_API_KEY"] = _secret("OPENAI_API_KEY")
 
 
 # Resolve or suppress warnings
@@ -65,10 +104,130 @@ logging.basicConfig(level=logging.INFO)
 DATA_FOLDER = 'data'
 persist_directory_openai = 'data/chroma_db_llamaparse-openai'
 persist_directory_huggingface = 'data/chroma_db_llamaparse-huggincface'
+# Built from DATA_FOLDER with the offline hash embeddings (fake_backends.py)
+persist_directory_fake = 'data/chroma_db_fake'
 collection_name = 'rag'
 CHUNK_SIZE = 3000
 CHUNK_OVERLAP = 200
 
+# Routing parameters
+# "structured": one structured-output call answers both router checks (default)
+# "concurrent": send the business and country yes/no checks at once
+# "sequential": run the yes/no checks one after the other
+ROUTER_MODE = "structured"
+
+# Document grading parameters
+# "batch": grade all retrieved chunks with one structured-output call (default)
+# "parallel": one grader call per chunk, sent concurrently
+# "sequential": one grader call per chunk, one after the other
+# "rerank": score chunks locally with a FlashRank cross-encoder, no LLM calls
+GRADING_MODE = "batch"
+# Maximum concurrent grader calls per provider in "parallel" mode (rate limits differ)
+GRADER_MAX_CONCURRENCY = {
+    "openai": 5,
+    "groq": 2,
+}
+# Context window (tokens) of the grading models; batches are split to fit
+GRADER_CONTEXT_TOKENS = {
+    "gpt-4.1": 1047576,
+    "gpt-4o": 128000,
+    "llama-3.1-8b-instant": 131072,
+    "llama-3.3-70b-versatile": 131072,
+    "llama3-70b-8192": 8192,
+    "llama3-8b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+    "gemma2-9b-it": 8192,
+    "deepseek-r1-distill-llama-70b": 131072,
+}
+DEFAULT_GRADER_CONTEXT_TOKENS = 8192
+# Share of the context window used for the chunks (the rest is left for the
+# instructions and the structured answer)
+GRADER_BATCH_CONTEXT_SHARE = 0.5
+
+# Persistent cache of chunk grades, shared across sessions and restarts
+# (not used in "rerank" mode, which grades locally)
+GRADE_CACHE_ENABLED = True
+# Offline runs (fake backends) keep their fake grades and web results apart
+CACHE_DIRECTORY = 'data/cache/fake' if FAKE_BACKENDS_ENABLED else 'data/cache'
+GRADE_CACHE_PATH = f'{CACHE_DIRECTORY}/grade_cache.sqlite3'
+GRADE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+GRADE_CACHE_MAX_ENTRIES = 50000
+
+# Per-query latency budget in seconds. Web search is cut off at its deadline
+# (or when the total budget runs out) and the answer is generated without it;
+# the other stages are measured and counted as deadline misses when over budget.
+LATENCY_BUDGET_SECONDS = {
+    "total": 60.0,
+    "route": 10.0,  # also the request timeout of the router model
+    "retrieve": 15.0,  # vector retrieval (plus grading in hybrid search)
+    "grade": 15.0,
+    "web_search": 25.0,
+    "generate": 45.0,
+}
+
+# Persistent cache of web search results per (country, domain list, question)
+WEB_CACHE_ENABLED = True
+WEB_CACHE_PATH = f'{CACHE_DIRECTORY}/web_search_cache.sqlite3'
+WEB_CACHE_TTL_SECONDS = 24 * 3600  # results are fresh for this long (regulations change slowly)
+WEB_CACHE_STALE_SECONDS = 6 * 24 * 3600  # then served stale for this long while refreshing in the background
+
+# Local reranker used in "rerank" grading mode (runs on CPU)
+FLASHRANK_MODEL = "ms-marco-MultiBERT-L-12"  # multilingual cross-encoder
+RERANK_TOP_N = 3  # keep at most this many chunks
+RERANK_SCORE_THRESHOLD = 0.3  # and only chunks scoring at least this
+
+# Local embedding pre-router in front of the LLM router
+PRE_ROUTER_ENABLED = True
+PRE_ROUTER_MODEL = "all-MiniLM-L6-v2"  # small sentence-transformers model, runs on CPU
+# Confidence thresholds per pre-router embedding model, since similarity scales
+# differ between models; models without an entry never decide locally
+PRE_ROUTER_THRESHOLDS = {
+    PRE_ROUTER_MODEL: {
+        "min_similarity": 0.55,  # cosine similarity to the selected country's centroid
+        "min_margin": 0.08,  # lead over the other countries and the unrelated group
+    },
+}
+
+# Example questions used to build the pre-router centroids
+pre_router_examples = {
+    "business/Finland": [
+        "How do I register a company in Finland?",
+        "What taxes do entrepreneurs pay in Finland?",
+        "What are the requirements for a foreigner to start a business in Finland?",
+        "How do I start a business in Finland?",
+        "How much is VAT in Finland?",
+        "Do I need a residence permit for an entrepreneur in Finland?",
+        "How do I hire my first employee in Finland?",
+        "What funding does Business Finland offer to startups?",
+        "How do I register as a sole trader (toiminimi) in Finland?",
+        "What is the corporate tax rate in Finland?",
+    ],
+    "business/Estonia": [
+        "How do I register a company in Estonia?",
+        "What is e-Residency in Estonia?",
+        "What taxes do entrepreneurs pay in Estonia?",
+        "How do I start a business in Estonia?",
+        "How much is VAT in Estonia?",
+        "How do I open a business bank account in Estonia?",
+        "What is the corporate income tax in Estonia?",
+        "How do I apply for Estonian e-Residency to run my company?",
+        "What permits do I need to open a restaurant in Tallinn?",
+        "How do I hire employees in Estonia?",
+    ],
+    "unrelated": [
+        "What is the weather like today?",
+        "Tell me a joke.",
+        "Who won the football world cup?",
+        "Give me a recipe for chocolate cake.",
+        "What is the capital of Australia?",
+        "Write a poem about the sea.",
+        "How tall is Mount Everest?",
+        "Recommend a good movie to watch tonight.",
+        "How do I fix a flat bicycle tire?",
+        "Explain the theory of relativity.",
+    ],
+}
+
 # Define domain lists for each country
 include_domains_finland = [
     "migri.fi",
@@ -285,8 +444,12 @@ def staticChunker(folder_path):
             file_path = os.path.join(folder_path, file_name)
             print(f"Processing file: {file_path}")
 
-            # Load documents from the Markdown file
-            loader = UnstructuredMarkdownLoader(file_path)
+            # Load documents from the Markdown file. The unstructured parser
+            # downloads NLP models, so offline runs read the plain text
+            if FAKE_BACKENDS_ENABLED:
+                loader = TextLoader(file_path, encoding="utf-8")
+            else:
+                loader = UnstructuredMarkdownLoader(file_path)
             documents = loader.load()
 
             # Add file-specific metadata (optional)
@@ -301,14 +464,16 @@ def staticChunker(folder_path):
     return docs
 
 # @st.cache_resource
-def load_or_create_vs(persist_directory):
+def load_or_create_vs(persist_directory, embed_model=None):
+    if embed_model is None:
+        embed_model = st.session_state.embed_model
     # Check if the vector store directory exists
     if os.path.exists(persist_directory):
         print("Loading existing vector store...")
         # Load the existing vector store
         vectorstore = Chroma(
             persist_directory=persist_directory,
-            embedding_function=st.session_state.embed_model,
+            embedding_function=embed_model,
             collection_name=collection_name
         )
     else:
@@ -318,7 +483,7 @@ def load_or_create_vs(persist_directory):
         # Create and persist a new Chroma vector store
         vectorstore = Chroma.from_documents(
             documents=docs,
-            embedding=st.session_state.embed_model,
+            embedding=embed_model,
             persist_directory=persist_directory,
             collection_name=collection_name
         )
@@ -327,6 +492,113 @@ def load_or_create_vs(persist_directory):
     return vectorstore
 
 
+# Process-wide vector stores, one per (persist directory, embedding model).
+# The index is opened once and only queried afterwards; Chroma guards its
+# HNSW index with a read-write lock, so concurrent similarity searches are safe.
+_vectorstore_registry = {}
+_vectorstore_lock = threading.Lock()
+
+
+def get_shared_vectorstore(persist_directory, embedding_model_name, embed_model):
+    """Return the shared vector store, loading (or creating) it on first use."""
+    key = (os.path.abspath(persist_directory), embedding_model_name)
+    # Held while loading, so a missing store is only built once
+    with _vectorstore_lock:
+        if key not in _vectorstore_registry:
+            _vectorstore_registry[key] = load_or_create_vs(persist_directory, embed_model)
+        return _vectorstore_registry[key]
+
+
+@dataclasses.dataclass
+class RagRuntime:
+    """
+    Request-scoped objects the graph nodes need: country, models, retriever,
+    prompt and clients. Passed as config["configurable"]["runtime"], so the
+    same compiled graph can serve concurrent requests from any thread or
+    process, with or without Streamlit.
+    """
+    selected_country: str
+    selected_model: str
+    llm: object
+    router_llm: object
+    grader_llm: object
+    doc_grader: object
+    batch_doc_grader: object
+    rag_prompt: object
+    embed_model: object = None
+    retriever: object = None  # None for Estonia, which only uses web search
+    openai_client: object = None
+    async_openai_client: object = None
+
+
+# Process-wide OpenAI clients for web search (thread-safe; the async one is
+# only used on the shared event loop)
+_openai_clients = None
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_clients():
+    """Return the shared (OpenAI, AsyncOpenAI) clients."""
+    global _openai_clients
+    with _openai_clients_lock:
+        if _openai_clients is None and FAKE_BACKENDS_ENABLED:
+            _openai_clients = (FakeOpenAI(), FakeAsyncOpenAI())
+        elif _openai_clients is None:
+            _openai_clients = (OpenAI(api_key=os.environ["OPENAI_API_KEY"]),
+                               AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"]))
+        return _openai_clients
+
+
+def get_rag_prompt(country):
+    return estonia_rag_prompt if country == "Estonia" else finland_rag_prompt
+
+
+def create_runtime(country, model_name, selected_embedding_model, selected_routing_model,
+                   selected_grading_model, answer_style="Concise"):
+    """Build the runtime of a request without Streamlit. Models and vector stores are shared."""
+    embed_model = get_embedding_model(selected_embedding_model)
+
+    # Vector store only for Finland, Estonia uses web search only
+    retriever = None
+    if country == "Finland":
+        persist_directory = persist_directory_openai if "text-" in selected_embedding_model else persist_directory_huggingface
+        if is_fake_model(selected_embedding_model):
+            persist_directory = persist_directory_fake
+        retriever = get_shared_vectorstore(
+            persist_directory, selected_embedding_model, embed_model).as_retriever(search_kwargs={"k": 5})
+
+    router_llm = get_router_llm(selected_routing_model)
+    # Precompile the router prompts and chains for this country
+    get_router_chains(country, router_llm)
+    grader_llm = get_grading_llm(selected_grading_model)
+    openai_client, async_openai_client = get_openai_clients()
+
+    return RagRuntime(
+        selected_country=country,
+        selected_model=model_name,
+        llm=get_llm(model_name, answer_style),
+        router_llm=router_llm,
+        grader_llm=grader_llm,
+        doc_grader=initialize_grader_chain(grader_llm),
+        batch_doc_grader=initialize_batch_grader_chain(grader_llm),
+        rag_prompt=get_rag_prompt(country),
+        embed_model=embed_model,
+        retriever=retriever,
+        openai_client=openai_client,
+        async_openai_client=async_openai_client,
+    )
+
+
+def runtime_from_session_state(session_state=None):
+    """Snapshot the runtime of a Streamlit session (initialized by initialize_app)."""
+    if session_state is None:
+        session_state = st.session_state
+    return RagRuntime(**{
+        field.name: getattr(session_state, field.name, None)
+        for field in dataclasses.fields(RagRuntime)
+    })
+
+
 def initialize_app(model_name, selected_embedding_model, selected_routing_model, selected_grading_model, hybrid_search, internet_search, answer_style):
     """
     Initialize embeddings, vectorstore, retriever, and LLM for the RAG workflow.
@@ -352,34 +624,17 @@ def initialize_app(model_name, selected_embedding_model, selected_routing_model,
     # Reinitialize components only if settings have changed
     if state_changed:
         try:
-            st.session_state.embed_model = initialize_embedding_model(
-                selected_embedding_model)
-
-            # Update vectorstore (only for Finland, not needed for Estonia)
-            if st.session_state.selected_country == "Finland":
-                persist_directory = persist_directory_openai if "text-" in selected_embedding_model else persist_directory_huggingface
-                st.session_state.vectorstore = load_or_create_vs(persist_directory)
-                st.session_state.retriever = st.session_state.vectorstore.as_retriever(
-                    search_kwargs={"k": 5})
-            else:
-                # For Estonia, set dummy vectors or empty retriever as we'll only use web search
-                st.session_state.retriever = None
-
-            st.session_state.llm = initialize_llm(model_name, answer_style)
-            st.session_state.router_llm = initialize_router_llm(
-                selected_routing_model)
-            st.session_state.grader_llm = initialize_grading_llm(
-                selected_grading_model)
-            st.session_state.doc_grader = initialize_grader_chain()
-
-            # Initialize OpenAI client for web search
-            st.session_state.openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
-            # Set the appropriate RAG prompt based on selected country
-            if st.session_state.selected_country == "Estonia":
-                st.session_state.rag_prompt = estonia_rag_prompt
-            else:
-                st.session_state.rag_prompt = finland_rag_prompt
+            runtime = create_runtime(
+                st.session_state.selected_country, model_name, selected_embedding_model,
+                selected_routing_model, selected_grading_model, answer_style)
+
+            # The rest of the app (follow-up questions, semantic cache) reads
+            # the models from the session state
+            for field in dataclasses.fields(runtime):
+                if field.name not in ("selected_country", "selected_model"):
+                    st.session_state[field.name] = getattr(runtime, field.name)
+            if runtime.retriever is not None:
+                st.session_state.vectorstore = runtime.retriever.vectorstore
 
             # Save updated state
             st.session_state.current_model_state.update({
@@ -395,24 +650,22 @@ def initialize_app(model_name, selected_embedding_model, selected_routing_model,
                 st.warning(f"Continuing with previous configuration")
             else:
                 # Fallback to OpenAI if no previous state
-                st.session_state.llm = ChatOpenAI(
-                    model="gpt-4.1-2025-04-14", temperature=0.0, streaming=True)
-                st.session_state.router_llm = ChatOpenAI(
-                    model="gpt-4.1-mini-2025-04-14", temperature=0.0)
-                st.session_state.grader_llm = ChatOpenAI(
-                    model="gpt-4.1-mini-2025-04-14", temperature=0.0)
-                st.session_state.openai_client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-                
-                # Set a default RAG prompt based on country
-                if st.session_state.selected_country == "Estonia":
-                    st.session_state.rag_prompt = estonia_rag_prompt
-                else:
-                    st.session_state.rag_prompt = finland_rag_prompt
+                st.session_state.llm = get_shared_model(
+                    "openai", "gpt-4.1-2025-04-14", temperature=0.0, streaming=True)
+                st.session_state.router_llm = get_shared_model(
+                    "openai", "gpt-4.1-mini-2025-04-14", temperature=0.0)
+                st.session_state.grader_llm = get_shared_model(
+                    "openai", "gpt-4.1-mini-2025-04-14", temperature=0.0)
+                st.session_state.doc_grader = initialize_grader_chain()
+                st.session_state.batch_doc_grader = initialize_batch_grader_chain()
+                st.session_state.openai_client, st.session_state.async_openai_client = get_openai_clients()
+                st.session_state.rag_prompt = get_rag_prompt(st.session_state.selected_country)
 
     print(f"Using LLM: {model_name}, Router LLM: {selected_routing_model}, Grader LLM:{selected_grading_model}, embedding model: {selected_embedding_model}")
 
     try:
-        return workflow.compile()
+        # Compiled once per process; reruns and new sessions reuse it
+        return get_compiled_workflow()
     except Exception as e:
         st.error(f"Error compiling workflow: {e}")
         # Return a simple dummy workflow that just echoes the input
@@ -420,55 +673,88 @@ def initialize_app(model_name, selected_embedding_model, selected_routing_model,
 # @st.cache_resource
 
 
-def initialize_llm(model_name, answer_style):
-    if "llm" not in st.session_state or st.session_state.llm.model_name != model_name:
-        if answer_style == "Concise":
-            temperature = 0.0
-        elif answer_style == "Moderate":
-            temperature = 0.0
-        elif answer_style == "Explanatory":
-            temperature = 0.0
-
-        if "gpt-" in model_name:
-            st.session_state.llm = ChatOpenAI(
-                model=model_name, temperature=temperature, streaming=True)
-        elif "deepseek-" in model_name:
-            # Deepseek models need "hidden" reasoning_format to prevent <think> tags that otherwise cause issues
-            st.session_state.llm = ChatGroq(
-                model=model_name,
-                temperature=temperature,
-                streaming=True,
-                # model_kwargs={"reasoning_format": "hidden"}
-            )
-        else:
-            st.session_state.llm = ChatGroq(
-                model=model_name, temperature=temperature, streaming=True)
+# Process-wide registry of model clients and embedding models, shared by all
+# sessions: one instance per (provider, model, params), so memory and HTTP
+# connection pools grow with the number of distinct models, not of users
+model_providers = {
+    "openai": lambda model_name, **params: ChatOpenAI(model=model_name, **params),
+    "groq": lambda model_name, **params: ChatGroq(model=model_name, **params),
+    "openai-embeddings": lambda model_name, **params: OpenAIEmbeddings(model=model_name, **params),
+    "huggingface-embeddings": lambda model_name, **params: HuggingFaceEmbeddings(model_name=model_name, **params),
+    # Offline stand-ins, see fake_backends.py
+    "fake-chat": lambda model_name, **params: FakeChatModel(model_name=model_name),
+    "fake-embeddings": lambda model_name, **params: HashEmbeddings(),
+}
+_model_registry = {}
+_model_locks = {}
+_model_registry_lock = threading.Lock()
+
+
+def get_shared_model(provider, model_name, **params):
+    """
+    Return the shared model for (provider, model, params), creating it on
+    first use. Models are only ever used with per-call configuration
+    (callbacks, streaming handlers), so one instance can serve all sessions.
+    With fake backends enabled (or a "fake-" model name) the offline
+    stand-in of the provider is returned instead.
+    """
+    if is_fake_model(model_name) and not provider.startswith("fake-"):
+        provider = "fake-embeddings" if provider.endswith("-embeddings") else "fake-chat"
+        params = {}
+    key = (provider, model_name, json.dumps(params, sort_keys=True))
+    with _model_registry_lock:
+        if key in _model_registry:
+            return _model_registry[key]
+        # Loading one model (e.g. embedding weights) does not block lookups of others
+        key_lock = _model_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        if key not in _model_registry:
+            print(f"Loading {provider} model {model_name} {params or ''}")
+            model = model_providers[provider](model_name, **params)
+            with _model_registry_lock:
+                _model_registry[key] = model
+    return _model_registry[key]
+
+
+def get_llm(model_name, answer_style):
+    """Return the shared answering model without touching the session state."""
+    if answer_style == "Concise":
+        temperature = 0.0
+    elif answer_style == "Moderate":
+        temperature = 0.0
+    elif answer_style == "Explanatory":
+        temperature = 0.0
+
+    if "gpt-" in model_name:
+        return get_shared_model(
+            "openai", model_name, temperature=temperature, streaming=True)
+    elif "deepseek-" in model_name:
+        # Deepseek models need "hidden" reasoning_format to prevent <think> tags that otherwise cause issues
+        return get_shared_model(
+            "groq",
+            model_name,
+            temperature=temperature,
+            streaming=True,
+            # model_kwargs={"reasoning_format": "hidden"}
+        )
+    return get_shared_model(
+        "groq", model_name, temperature=temperature, streaming=True)
+
 
+def initialize_llm(model_name, answer_style):
+    st.session_state.llm = get_llm(model_name, answer_style)
     return st.session_state.llm
 
 
-def initialize_embedding_model(selected_embedding_model):
-    # Check if the embed_model exists in session_state
-    if "embed_model" not in st.session_state:
-        st.session_state.embed_model = None
-
-    # Check if the current model matches the selected one
-    current_model_name = None
-    if st.session_state.embed_model:
-        if hasattr(st.session_state.embed_model, "model"):
-            current_model_name = st.session_state.embed_model.model
-        elif hasattr(st.session_state.embed_model, "model_name"):
-            current_model_name = st.session_state.embed_model.model_name
-
-    # Initialize a new model if it doesn't match the selected one
-    if current_model_name != selected_embedding_model:
-        if "text-" in selected_embedding_model:
-            st.session_state.embed_model = OpenAIEmbeddings(
-                model=selected_embedding_model)
-        else:
-            st.session_state.embed_model = HuggingFaceEmbeddings(
-                model_name=selected_embedding_model)
+def get_embedding_model(selected_embedding_model):
+    # HuggingFace weights are loaded once per process, not per session
+    if "text-" in selected_embedding_model:
+        return get_shared_model("openai-embeddings", selected_embedding_model)
+    return get_shared_model("huggingface-embeddings", selected_embedding_model)
+
 
+def initialize_embedding_model(selected_embedding_model):
+    st.session_state.embed_model = get_embedding_model(selected_embedding_model)
     return st.session_state.embed_model
 
 # @st.cache_resource
@@ -476,47 +762,53 @@ def initialize_embedding_model(selected_embedding_model):
 # FIX: mixtral model won't work with ChatGroq idk why. Maybe add gpt-4o-mini as fallback
 
 
-def initialize_router_llm(selected_routing_model):
-    if "router_llm" not in st.session_state or st.session_state.router_llm.model_name != selected_routing_model:
-        if "gpt-" in selected_routing_model:
-            st.session_state.router_llm = ChatOpenAI(
-                model=selected_routing_model, temperature=0.0)
-        elif "deepseek-" in selected_routing_model:
-            st.session_state.router_llm = ChatGroq(
-                model=selected_routing_model,
-                temperature=0.0,
-                model_kwargs={"reasoning_format": "hidden"}
-            )
-        # Uncomment this block to use gpt-4o-mini as a fallback for mixtral models. Because 20.2.2025 mixtral model won't in router_llm
-        # elif "mixtral" in selected_routing_model.lower():
-        #     st.session_state.router_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
-        else:
-            st.session_state.router_llm = ChatGroq(
-                model=selected_routing_model, temperature=0.0)
+def get_router_llm(selected_routing_model):
+    if "gpt-" in selected_routing_model:
+        return get_shared_model(
+            "openai", selected_routing_model, temperature=0.0,
+            timeout=LATENCY_BUDGET_SECONDS["route"])
+    elif "deepseek-" in selected_routing_model:
+        return get_shared_model(
+            "groq",
+            selected_routing_model,
+            temperature=0.0,
+            timeout=LATENCY_BUDGET_SECONDS["route"],
+            model_kwargs={"reasoning_format": "hidden"}
+        )
+    # Uncomment this block to use gpt-4o-mini as a fallback for mixtral models. Because 20.2.2025 mixtral model won't in router_llm
+    # elif "mixtral" in selected_routing_model.lower():
+    #     return get_shared_model("openai", "gpt-4o-mini", temperature=0.0)
+    return get_shared_model(
+        "groq", selected_routing_model, temperature=0.0,
+        timeout=LATENCY_BUDGET_SECONDS["route"])
 
+
+def initialize_router_llm(selected_routing_model):
+    st.session_state.router_llm = get_router_llm(selected_routing_model)
     return st.session_state.router_llm
 
 # @st.cache_resource
 
 
-def initialize_grading_llm(selected_grading_model):
-    if "grader_llm" not in st.session_state or st.session_state.grader_llm.model_name != selected_grading_model:
-        if "gpt-" in selected_grading_model:
-            st.session_state.grader_llm = ChatOpenAI(
-                model=selected_grading_model, temperature=0.0, max_tokens=4000)
-        elif "deepseek-" in selected_grading_model:
-            # Deepseek-models need "hidden" reasoning_format to prevent <think> tags from leaking
-            st.session_state.grader_llm = ChatGroq(
-                model=selected_grading_model,
-                temperature=0.0,
-                model_kwargs={"reasoning_format": "hidden"}
-            )
-        else:
-            st.session_state.grader_llm = ChatGroq(
-                model=selected_grading_model, temperature=0.0)
+def get_grading_llm(selected_grading_model):
+    if "gpt-" in selected_grading_model:
+        return get_shared_model(
+            "openai", selected_grading_model, temperature=0.0, max_tokens=4000)
+    elif "deepseek-" in selected_grading_model:
+        # Deepseek-models need "hidden" reasoning_format to prevent <think> tags from leaking
+        return get_shared_model(
+            "groq",
+            selected_grading_model,
+            temperature=0.0,
+            model_kwargs={"reasoning_format": "hidden"}
+        )
+    return get_shared_model(
+        "groq", selected_grading_model, temperature=0.0)
 
-    return st.session_state.grader_llm
 
+def initialize_grading_llm(selected_grading_model):
+    st.session_state.grader_llm = get_grading_llm(selected_grading_model)
+    return st.session_state.grader_llm
 
 model_list = [
     "llama-3.1-8b-instant",
@@ -533,7 +825,10 @@ model_list = [
 ]
 
 
-def initialize_grader_chain():
+def initialize_grader_chain(grader_llm=None):
+    if grader_llm is None:
+        grader_llm = st.session_state.grader_llm
+
     # Data model for LLM output format
     class GradeDocuments(BaseModel):
         """Binary score for relevance check on retrieved documents."""
@@ -542,7 +837,7 @@ def initialize_grader_chain():
         )
 
     # LLM for grading
-    structured_llm_grader = st.session_state.grader_llm.with_structured_output(
+    structured_llm_grader = grader_llm.with_structured_output(
         GradeDocuments)
 
     # Prompt template for grading
@@ -565,29 +860,379 @@ def initialize_grader_chain():
     return grade_prompt | structured_llm_grader
 
 
-def grade_documents(state):
-    question = state["question"]
-    documents = state.get("documents", [])
-    filtered_docs = []
+def initialize_batch_grader_chain(grader_llm=None):
+    if grader_llm is None:
+        grader_llm = st.session_state.grader_llm
 
-    if not documents:
-        print("No documents retrieved for grading.")
-        return {"documents": [], "question": question, "web_search_needed": "Yes"}
+    # Data model for LLM output format
+    class ChunkGrade(BaseModel):
+        """Binary score for one retrieved chunk."""
+        chunk_id: int = Field(
+            description="Number of the chunk as given in the prompt"
+        )
+        binary_score: str = Field(
+            description="Chunk is relevant to the question, 'yes' or 'no'"
+        )
 
-    print(
-        f"Grading retrieved documents with {st.session_state.grader_llm.model_name}")
+    class BatchGradeDocuments(BaseModel):
+        """Binary scores for relevance check on a batch of retrieved chunks."""
+        grades: List[ChunkGrade] = Field(
+            description="One grade for every chunk in the prompt"
+        )
+
+    # LLM for grading
+    structured_llm_grader = grader_llm.with_structured_output(
+        BatchGradeDocuments)
+
+    # Prompt template for grading
+    SYS_PROMPT = """You are an expert grader assessing relevance of retrieved document chunks to a user question.
+
+    Follow these instructions for grading:
+    - Grade every chunk independently and return exactly one grade per chunk, using its chunk number.
+    - If a chunk contains keyword(s) or semantic meaning related to the question, grade it as relevant.
+    - Each grade should be either 'Yes' or 'No' to indicate whether the chunk is relevant to the question or not."""
+
+    grade_prompt = ChatPromptTemplate.from_messages([
+        ("system", SYS_PROMPT),
+        ("human", """Retrieved chunks:
+    {documents}
+    User question:
+    {question}
+    """),
+    ])
 
+    # Build grader chain
+    return grade_prompt | structured_llm_grader
+
+
+def is_relevant(binary_score):
+    return binary_score.strip().lower() == "yes"
+
+
+def split_grading_batches(documents, model_name):
+    """
+    Split chunks into batches whose estimated size fits the grader model's
+    context window. Tokens are estimated as characters / 4.
+    """
+    context_tokens = next(
+        (tokens for prefix, tokens in GRADER_CONTEXT_TOKENS.items() if model_name.startswith(prefix)),
+        DEFAULT_GRADER_CONTEXT_TOKENS)
+    budget = int(context_tokens * GRADER_BATCH_CONTEXT_SHARE)
+
+    batches, current, current_tokens = [], [], 0
     for count, doc in enumerate(documents):
+        tokens = len(doc.page_content) // 4 + 1
+        if current and current_tokens + tokens > budget:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append((count, doc))
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def get_runtime(config=None):
+    """
+    RagRuntime of the request, passed as config["configurable"]["runtime"].
+    Direct calls without it fall back to a snapshot of st.session_state.
+    """
+    runtime = (config or {}).get("configurable", {}).get("runtime")
+    if runtime is None:
+        return runtime_from_session_state()
+    return runtime
+
+
+def record_event(name, **data):
+    """
+    Report an event (cache hit, fallback, deadline miss) to the callbacks of
+    the current workflow run, e.g. telemetry.TurnTelemetry. Does nothing
+    outside of a run. Every event is also counted in the Prometheus metrics.
+    """
+    metrics.observe_event(name, data)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            dispatch_custom_event(name, data)
+        except RuntimeError:
+            pass  # not called from within a workflow run
+        return
+    # On the event loop the event is dispatched by a task, so the loop is not blocked
+    task = asyncio.ensure_future(_adispatch_event(name, data))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _adispatch_event(name, data):
+    try:
+        await adispatch_custom_event(name, data)
+    except RuntimeError:
+        pass
+
+
+# Sync and async nodes share one implementation, a generator of steps. A step
+# is a call the node needs, as (sync function, async function, args); the
+# generator receives the result of the call, or has its exception raised at
+# the yield. run_steps makes the calls directly (invoke, stream); arun_steps
+# awaits the async function, or runs the sync one in a worker thread when
+# there is none (ainvoke, astream).
+
+
+def invoke_step(runnable, value):
+    """Step that invokes a runnable (chain, model or retriever)."""
+    return runnable.invoke, runnable.ainvoke, (value,)
+
+
+def batch_step(runnable, values, **kwargs):
+    """Step that runs a runnable on several inputs concurrently."""
+    return functools.partial(runnable.batch, **kwargs), functools.partial(runnable.abatch, **kwargs), (values,)
+
+
+def thread_step(fn, *args):
+    """Step that calls a blocking function (in a worker thread from async nodes)."""
+    return fn, None, args
+
+
+def run_steps(steps):
+    """Run a step generator synchronously. Returns the generator's return value."""
+    try:
+        step = next(steps)
+        while True:
+            fn, _, args = step
+            try:
+                result = fn(*args)
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def arun_steps(steps):
+    """Async version of run_steps."""
+    try:
+        step = next(steps)
+        while True:
+            fn, afn, args = step
+            try:
+                if afn is None:
+                    result = await asyncio.to_thread(fn, *args)
+                else:
+                    result = await afn(*args)
+            except Exception as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+def sequential_grading_steps(runtime, documents, question, label="Chunk", offset=0):
+    """Grade chunks one grader call at a time. Returns one verdict per chunk."""
+    verdicts = []
+    for count, doc in enumerate(documents, start=offset):
         try:
             # Evaluate document relevance
-            score = st.session_state.doc_grader.invoke(
-                {"documents": [doc], "question": question})
-            print(f"Chunk {count} relevance: {score}")
-            if score.binary_score == "Yes":
-                filtered_docs.append(doc)
+            score = yield invoke_step(
+                runtime.doc_grader, {"documents": [doc], "question": question})
+            print(f"{label} {count} relevance: {score}")
+            verdicts.append(is_relevant(score.binary_score))
+        except Exception as e:
+            print(f"Error grading {label.lower()} {count}: {e}")
+            verdicts.append(False)
+    return verdicts
+
+
+def get_model_provider(model_name):
+    """Provider serving a model, following the same rules as the initialize_* functions."""
+    return "openai" if "gpt-" in model_name else "groq"
+
+
+def get_grader_concurrency(runtime, documents):
+    provider = get_model_provider(runtime.grader_llm.model_name)
+    max_concurrency = GRADER_MAX_CONCURRENCY.get(provider, 1)
+    print(f"Grading {len(documents)} chunks with up to {max_concurrency} concurrent calls")
+    return max_concurrency
+
+
+def collect_verdicts(scores, label):
+    """Turn grader results (or the exceptions raised instead) into verdicts."""
+    verdicts = []
+    for count, score in enumerate(scores):
+        if isinstance(score, Exception):
+            print(f"Error grading {label.lower()} {count}: {score}")
+            verdicts.append(False)
+        else:
+            print(f"{label} {count} relevance: {score}")
+            verdicts.append(is_relevant(score.binary_score))
+    return verdicts
+
+
+def parallel_grading_steps(runtime, documents, question, label="Chunk"):
+    """
+    Grade chunks with one grader call each, sent concurrently with a per-provider
+    concurrency limit. Returns one verdict per chunk, in the original order.
+    """
+    scores = yield batch_step(
+        runtime.doc_grader,
+        [{"documents": [doc], "question": question} for doc in documents],
+        config={"max_concurrency": get_grader_concurrency(runtime, documents)},
+        return_exceptions=True,
+    )
+    return collect_verdicts(scores, label)
+
+
+# Process-wide FlashRank reranker, loaded on first use
+_reranker_lock = threading.Lock()
+_reranker = None
+
+
+def get_reranker():
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            print(f"Loading FlashRank reranker {FLASHRANK_MODEL}")
+            _reranker = FlashrankRerank(model=FLASHRANK_MODEL, top_n=RERANK_TOP_N)
+    return _reranker
+
+
+def grade_chunks_reranked(runtime, documents, question, label="Chunk"):
+    """
+    Score chunks locally with the FlashRank cross-encoder instead of the LLM
+    grader. Keeps the RERANK_TOP_N best chunks scoring at least
+    RERANK_SCORE_THRESHOLD. Returns one verdict per chunk.
+    """
+    # Tag copies with their position, the reranker returns new Document objects
+    indexed_docs = [
+        Document(page_content=doc.page_content, metadata={**doc.metadata, "chunk_index": count})
+        for count, doc in enumerate(documents)
+    ]
+    verdicts = [False] * len(documents)
+    try:
+        ranked = get_reranker().compress_documents(indexed_docs, question)
+    except Exception as e:
+        print(f"Error reranking chunks, falling back to the LLM grader: {e}")
+        return run_steps(sequential_grading_steps(runtime, documents, question, label))
+
+    for doc in ranked:
+        count = doc.metadata["chunk_index"]
+        score = doc.metadata.get("relevance_score", 0.0)
+        print(f"{label} {count} rerank score: {score:.3f}")
+        verdicts[count] = score >= RERANK_SCORE_THRESHOLD
+    return verdicts
+
+
+def format_grading_batch(batch):
+    return "\n\n".join(f"Chunk {count}:\n{doc.page_content}" for count, doc in batch)
+
+
+def apply_batch_grades(result, batch, verdicts, label):
+    """Copy the grades of a batch answer into verdicts, ignoring unknown chunk ids."""
+    for grade in result.grades:
+        if any(count == grade.chunk_id for count, _ in batch):
+            print(f"{label} {grade.chunk_id} relevance: {grade.binary_score}")
+            verdicts[grade.chunk_id] = is_relevant(grade.binary_score)
+
+
+def batched_grading_steps(runtime, documents, question, label="Chunk"):
+    """
+    Grade chunks with one structured-output call per batch, the batches sent
+    concurrently. Chunks the grader left out of its answer, and batches that
+    fail, are graded one by one. Returns one verdict per chunk.
+    """
+    verdicts = [None] * len(documents)
+    batches = split_grading_batches(documents, runtime.grader_llm.model_name)
+    print(f"Grading {len(documents)} chunks in {len(batches)} batch(es)")
+
+    results = yield batch_step(
+        runtime.batch_doc_grader,
+        [{"documents": format_grading_batch(batch), "question": question} for batch in batches],
+        return_exceptions=True,
+    )
+    for batch, result in zip(batches, results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            apply_batch_grades(result, batch, verdicts, label)
         except Exception as e:
-            print(f"Error grading document chunk {count}: {e}")
+            print(f"Error in batched grading, grading the batch chunk by chunk: {e}")
+
+        for count, doc in batch:
+            if verdicts[count] is None:
+                verdicts[count] = (yield from sequential_grading_steps(
+                    runtime, [doc], question, label, offset=count))[0]
+    return verdicts
+
+
+grade_cache = GradeCache(GRADE_CACHE_PATH, GRADE_CACHE_TTL_SECONDS, GRADE_CACHE_MAX_ENTRIES)
+
+
+def uncached_grading_steps(runtime, documents, question, label="Chunk"):
+    """Grade chunks with the configured GRADING_MODE. Returns one verdict per chunk."""
+    if GRADING_MODE == "batch":
+        return (yield from batched_grading_steps(runtime, documents, question, label))
+    elif GRADING_MODE == "rerank":
+        return (yield thread_step(grade_chunks_reranked, runtime, documents, question, label))
+    elif GRADING_MODE == "parallel":
+        return (yield from parallel_grading_steps(runtime, documents, question, label))
+    return (yield from sequential_grading_steps(runtime, documents, question, label))
+
+
+def read_cached_grades(documents, question, model_name):
+    """Cached verdicts (None for misses); all misses if the cache cannot be read."""
+    try:
+        verdicts = grade_cache.get_many(question, documents, model_name)
+    except Exception as e:
+        print(f"Error reading the grade cache: {e}")
+        verdicts = [None] * len(documents)
+    misses = [count for count, verdict in enumerate(verdicts) if verdict is None]
+    print(f"Grade cache: {len(documents) - len(misses)} hit(s), {len(misses)} miss(es)")
+    record_event("grade_cache", hits=len(documents) - len(misses), misses=len(misses))
+    return verdicts, misses
+
+
+def write_cached_grades(documents, question, model_name, verdicts):
+    try:
+        grade_cache.set_many(question, documents, model_name, verdicts)
+    except Exception as e:
+        print(f"Error writing the grade cache: {e}")
+
 
+def keep_relevant(documents, verdicts):
+    """Relevant chunks, in their original order. Reports the keep/drop counts."""
+    kept = [doc for doc, keep in zip(documents, verdicts) if keep]
+    record_event("chunk_grades", kept=len(kept), dropped=len(documents) - len(kept))
+    return kept
+
+
+def chunk_grading_steps(runtime, documents, question, label="Chunk"):
+    """
+    Grade retrieved chunks, reusing cached verdicts of the grader model for
+    chunks already graded for the same question.
+
+    Returns:
+    - relevant chunks, in their original order
+    """
+    use_cache = GRADE_CACHE_ENABLED and GRADING_MODE != "rerank"
+    if not use_cache:
+        verdicts = yield from uncached_grading_steps(runtime, documents, question, label)
+        return keep_relevant(documents, verdicts)
+
+    model_name = runtime.grader_llm.model_name
+    verdicts, misses = yield thread_step(read_cached_grades, documents, question, model_name)
+    if misses:
+        missed_docs = [documents[count] for count in misses]
+        new_verdicts = yield from uncached_grading_steps(runtime, missed_docs, question, label)
+        for count, verdict in zip(misses, new_verdicts):
+            verdicts[count] = verdict
+        yield thread_step(write_cached_grades, missed_docs, question, model_name, new_verdicts)
+
+    return keep_relevant(documents, verdicts)
+
+
+def grading_result(question, filtered_docs):
     if not filtered_docs:
         # Create a proper Document object for the error message
         error_doc = Document(page_content="No information from the documents found.")
@@ -597,6 +1242,29 @@ def grade_documents(state):
     return {"documents": filtered_docs, "question": question, "web_search_needed": web_search_needed}
 
 
+def grade_documents_steps(state, config=None):
+    runtime = get_runtime(config)
+    question = state["question"]
+    documents = state.get("documents", [])
+
+    if not documents:
+        print("No documents retrieved for grading.")
+        return {"documents": [], "question": question, "web_search_needed": "Yes"}
+
+    print(
+        f"Grading retrieved documents with {runtime.grader_llm.model_name}")
+
+    return grading_result(question, (yield from chunk_grading_steps(runtime, documents, question)))
+
+
+def grade_documents(state, config=None):
+    return run_steps(grade_documents_steps(state, config))
+
+
+async def agrade_documents(state, config=None):
+    return await arun_steps(grade_documents_steps(state, config))
+
+
 def route_after_grading(state):
     web_search_needed = state.get("web_search_needed", "No")
     print(f"Routing decision based on web_search_needed={web_search_needed}")
@@ -614,92 +1282,100 @@ class GraphState(TypedDict):
     web_search_needed: str
     documents: List[Document]
     answer_style: str
+    # time.time() when the question was received, for the latency budget
+    started_at: float
+    # Results of the parallel hybrid search branches, merged by hybrid_join
+    branch_documents: Annotated[List[Document], operator.add]
 
 
-def retrieve(state):
+def retrieve_steps(state, config=None):
     print("Retrieving documents")
     question = state["question"]
-    documents = st.session_state.retriever.invoke(question)
+    documents = yield invoke_step(get_runtime(config).retriever, question)
     return {"documents": documents, "question": question}
 
 
+def retrieve(state, config=None):
+    return run_steps(retrieve_steps(state, config))
+
+
+async def aretrieve(state, config=None):
+    return await arun_steps(retrieve_steps(state, config))
+
+
 def format_documents(documents):
     """Format documents into a single string for context."""
     return "\n\n".join(doc.page_content for doc in documents)
 
 
-def generate(state):
-    question = state["question"]
-    documents = state.get("documents", [])
-    answer_style = state.get("answer_style", "Concise")
+def get_generation_llm(runtime, model_name, answer_style):
+    """The session's answering model, or a new one for a fallback model."""
+    llm = getattr(runtime, "llm", None)
+    if llm is not None and llm.model_name == model_name:
+        return llm
+    return get_llm(model_name, answer_style)
 
-    if "llm" not in st.session_state:
-        st.session_state.llm = initialize_llm(
-            st.session_state.selected_model, answer_style)
 
+def get_generation_inputs(runtime, documents, question, answer_style):
+    inputs = {"context": documents, "question": question, "answer_style": answer_style}
     # Get the domains based on selected country
-    if st.session_state.selected_country == "Finland":
-        domains = ", ".join(include_domains_finland)
-        rag_chain = st.session_state.rag_prompt | st.session_state.llm | StrOutputParser()
+    if runtime.selected_country == "Finland":
+        inputs["domains_finland"] = ", ".join(include_domains_finland)
     else:  # Estonia
-        domains = ", ".join(include_domains_estonia)
-        rag_chain = st.session_state.rag_prompt | st.session_state.llm | StrOutputParser()
+        inputs["domains_estonia"] = ", ".join(include_domains_estonia)
+    return inputs
+
+
+def is_model_limit_error(error_message):
+    return ("rate_limit_exceeded" in error_message or "Request too large" in error_message
+            or "Please reduce the length of the messages or completion" in error_message)
+
+
+def generate_steps(state, config=None):
+    runtime = get_runtime(config)
+    question = state["question"]
+    documents = state.get("documents", [])
+    answer_style = state.get("answer_style", "Concise")
 
     if not documents:
         print("No documents available for generation.")
         return {"generation": "No relevant documents found.", "documents": documents, "question": question}
 
+    inputs = get_generation_inputs(runtime, documents, question, answer_style)
     tried_models = set()
-    original_model = st.session_state.selected_model
-    current_model = original_model
+    current_model = runtime.selected_model
 
     while len(tried_models) < len(model_list):
         try:
             tried_models.add(current_model)
-            st.session_state.llm = initialize_llm(current_model, answer_style)
-            
-            # Update the RAG chain with the appropriate prompt
-            if st.session_state.selected_country == "Finland":
-                rag_chain = st.session_state.rag_prompt | st.session_state.llm | StrOutputParser()
-                generation = rag_chain.invoke({
-                    "context": documents, 
-                    "question": question, 
-                    "answer_style": answer_style,
-                    "domains_finland": domains
-                })
-            else:  # Estonia
-                rag_chain = st.session_state.rag_prompt | st.session_state.llm | StrOutputParser()
-                generation = rag_chain.invoke({
-                    "context": documents, 
-                    "question": question, 
-                    "answer_style": answer_style,
-                    "domains_estonia": domains
-                })
+            # Fallback models are used for this question only, the session keeps its model
+            llm = get_generation_llm(runtime, current_model, answer_style)
+            rag_chain = runtime.rag_prompt | llm | StrOutputParser()
+            generation = yield invoke_step(rag_chain, inputs)
 
             print(f"Generating a {answer_style} length response.")
             print("Done.")
-
-            if current_model != original_model:
-                print(f"Reverting to original model: {original_model}")
-                st.session_state.llm = initialize_llm(
-                    original_model, answer_style)
-
             return {"documents": documents, "question": question, "generation": generation}
 
         except Exception as e:
             error_message = str(e)
-            if "rate_limit_exceeded" in error_message or "Request too large" in error_message or "Please reduce the length of the messages or completion" in error_message:
+            if is_model_limit_error(error_message):
                 print(f"Model's rate limit exceeded or request too large.")
+                failed_model = current_model
                 current_model = model_list[(model_list.index(
                     current_model) + 1) % len(model_list)]
                 print(f"Switching to model: {current_model}")
+                record_event("model_fallback", from_model=failed_model, to_model=current_model,
+                             error=error_message[:200])
             else:
+                record_event("generation_failed", error=error_message[:200])
                 return {
                     "generation": f"Error during generation: {error_message}",
                     "documents": documents,
                     "question": question,
                 }
 
+    record_event("generation_failed", error="all models over their limits")
     return {
         "generation": "Unable to process the request due to limitations across all models.",
         "documents": documents,
@@ -707,77 +1383,171 @@ def generate(state):
     }
 
 
-def handle_unrelated(state):
+def generate(state, config=None):
+    return run_steps(generate_steps(state, config))
+
+
+async def agenerate(state, config=None):
+    return await arun_steps(generate_steps(state, config))
+
+
+def handle_unrelated(state, config=None):
     question = state["question"]
     documents = state.get("documents", [])
     
     # Country-specific unrelated response
-    response = f"I apologize, but I'm designed to answer questions specifically related to business and entrepreneurship in {st.session_state.selected_country}."
+    response = f"I apologize, but I'm designed to answer questions specifically related to business and entrepreneurship in {get_runtime(config).selected_country}."
     
     documents.append(Document(page_content=response))
     return {"generation": response, "documents": documents, "question": question}
 
 
-def grade_retriever_hybrid(vector_docs, question):
+def hybrid_grading_result(filtered_docs):
+    if not filtered_docs:
+        # Create a proper Document object for the error message
+        error_doc = Document(page_content="No information from the documents found.")
+        filtered_docs = [error_doc]
+        print("No relevant vector documents found in hybrid search.")
+    else:
+        print(f"Found {len(filtered_docs)} relevant vector documents in hybrid search.")
+        
+    return filtered_docs
+
+
+def grade_retriever_hybrid_steps(runtime, vector_docs, question):
     """
     Grade only vector documents during hybrid search.
     
     Parameters:
+    - runtime: RagRuntime of the question
     - vector_docs: Document list from retriever
     - question: User question
     
     Returns:
     - filtered_vector_docs: List of relevant documents (or error message document)
     """
-    filtered_docs = []
-
     if not vector_docs:
         print("No vector documents available for grading in hybrid search.")
         # Create error document specifically for Smart guide results
         error_doc = Document(page_content="No information from the documents found.")
         return [error_doc]
 
-    print(f"Grading vector documents with {st.session_state.grader_llm.model_name} for hybrid search")
+    print(f"Grading vector documents with {runtime.grader_llm.model_name} for hybrid search")
 
-    for count, doc in enumerate(vector_docs):
+    return hybrid_grading_result((yield from chunk_grading_steps(runtime, vector_docs, question, label="Vector chunk")))
+
+
+web_search_cache = WebSearchCache(WEB_CACHE_PATH)
+
+# Web searches run here so the caller can stop waiting at the deadline. A
+# search that misses its deadline keeps its worker until it finishes, so a new
+# search waits for a free worker within its own deadline, and is refused at
+# once when every worker is held by such a late search
+WEB_SEARCH_WORKERS = 8
+_web_search_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_WORKERS, thread_name_prefix="web_search")
+_web_search_slots = threading.BoundedSemaphore(WEB_SEARCH_WORKERS)
+_late_web_searches = 0
+_late_web_searches_lock = threading.Lock()
+
+# Async web searches that outlived their deadline; kept referenced so they can finish and fill the cache
+_background_tasks = set()
+
+# Deadline misses per stage, for all sessions of the process
+_latency_lock = threading.Lock()
+deadline_misses = {stage: 0 for stage in LATENCY_BUDGET_SECONDS}
+
+
+def record_deadline_miss(stage):
+    with _latency_lock:
+        deadline_misses[stage] += 1
+    record_event("deadline_miss", stage=stage)
+
+
+def get_latency_metrics():
+    """Latency budget settings and the number of deadline misses per stage."""
+    with _latency_lock:
+        return {"budget_seconds": dict(LATENCY_BUDGET_SECONDS),
+                "deadline_misses": dict(deadline_misses)}
+
+
+def check_stage_latency(stage, state, start):
+    """Count a deadline miss if a stage (or, after generate, the whole question) ran over budget."""
+    elapsed = time.time() - start
+    if elapsed > LATENCY_BUDGET_SECONDS[stage]:
+        print(f"{stage} took {elapsed:.1f}s, over its {LATENCY_BUDGET_SECONDS[stage]:.0f}s budget")
+        record_deadline_miss(stage)
+    # generate is the last stage of every question
+    started_at = state.get("started_at")
+    if stage == "generate" and started_at and time.time() - started_at > LATENCY_BUDGET_SECONDS["total"]:
+        print(f"Question took {time.time() - started_at:.1f}s, over the total budget")
+        record_deadline_miss("total")
+
+
+def graph_node(name, node, anode=None, stage=None):
+    """
+    Combine the sync and async implementations of a node (or router) into one
+    runnable: invoke/stream on the compiled graph run `node`, ainvoke/astream
+    run `anode`. Cheap nodes without I/O have no async version and run `node`
+    in both cases. With a stage, run times are checked against its budget.
+    Every run is recorded in the Prometheus metrics.
+    """
+    def run_node(state, config):
+        start = time.time()
+        result = error = None
         try:
-            # Evaluate document relevance
-            score = st.session_state.doc_grader.invoke(
-                {"documents": [doc], "question": question})
-            print(f"Vector chunk {count} relevance: {score}")
-            if score.binary_score == "Yes":
-                filtered_docs.append(doc)
+            result = node(state, config)
+            return result
         except Exception as e:
-            print(f"Error grading vector document chunk {count}: {e}")
-            
-    if not filtered_docs:
-        # Create a proper Document object for the error message
-        error_doc = Document(page_content="No information from the documents found.")
-        filtered_docs = [error_doc]
-        print("No relevant vector documents found in hybrid search.")
-    else:
-        print(f"Found {len(filtered_docs)} relevant vector documents in hybrid search.")
-        
-    return filtered_docs
+            error = e
+            raise
+        finally:
+            metrics.observe_node(name, time.time() - start, result, error)
+            if stage:
+                check_stage_latency(stage, state, start)
+
+    async def arun_node(state, config):
+        start = time.time()
+        result = error = None
+        try:
+            if anode is None:
+                result = node(state, config)
+            else:
+                result = await anode(state, config)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            metrics.observe_node(name, time.time() - start, result, error)
+            if stage:
+                check_stage_latency(stage, state, start)
 
+    return RunnableLambda(run_node, afunc=arun_node, name=name)
 
-def web_search(state):
-    original_question = state["question"]
-    documents = state.get("documents", [])
-    
-    try:
-        print(f"Invoking OpenAI web search for {st.session_state.selected_country}...")
-        
-        # Configure country-specific settings
-        if st.session_state.selected_country == "Finland":
-            country_code = "FI"
-            domains_string = ", ".join(include_domains_finland)
-        else:  # Estonia
-            country_code = "EE"
-            domains_string = ", ".join(include_domains_estonia)
-        
-        # Create a domain restriction instruction
-        domains_instruction = f"""
+
+def web_search_deadline(state):
+    """Seconds the web search may take: its own budget, capped by what is left of the total budget."""
+    deadline = LATENCY_BUDGET_SECONDS["web_search"]
+    started_at = state.get("started_at")
+    if started_at:
+        remaining = LATENCY_BUDGET_SECONDS["total"] - (time.time() - started_at)
+        deadline = min(deadline, remaining)
+    return deadline
+
+
+def get_web_search_settings(country):
+    """Return (country_code, trusted domains) used for the web search of a country."""
+    if country == "Finland":
+        return "FI", include_domains_finland
+    return "EE", include_domains_estonia  # Estonia
+
+
+def get_web_search_request(question, country_code, domains):
+    """Arguments of the OpenAI Responses call that searches the trusted domains."""
+    domains_string = ", ".join(domains)
+
+    # Create a domain restriction instruction
+    domains_instruction = f"""
         **STRICT DOMAIN RESTRICTION**: This query MUST ONLY use information from these specific official, trusted domains - no exceptions:
         {domains_string}
 
@@ -785,78 +1555,567 @@ def web_search(state):
 
         **INSTRUCTION**: The query could be in any language. First detect the language and translate it into English. You do not necessarily need to find information in the same language. Your response should always be in English, regardless of the query language.
         """
+    
+    # Construct the query with domain restrictions
+    query = domains_instruction + "\n\n" + question
+    
+    return {
+        "model": "gpt-4.1",
+        "tools": [{
+            "type": "web_search_preview",
+            "user_location": {
+                "type": "approximate",
+                "country": country_code
+            }
+        }],
+        "input": query,
+    }
+
+
+def fetch_web_search_results(question, country_code, domains, openai_client):
+    """Call OpenAI's web search tool restricted to the trusted domains. Returns the output text."""
+    with metrics.time_web_search():
+        response = openai_client.responses.create(
+            **get_web_search_request(question, country_code, domains))
+    return response.output_text
+
+
+async def afetch_web_search_results(question, country_code, domains, async_openai_client):
+    """Async version of fetch_web_search_results, using an AsyncOpenAI client."""
+    with metrics.time_web_search():
+        response = await async_openai_client.responses.create(
+            **get_web_search_request(question, country_code, domains))
+    return response.output_text
+
+
+def refresh_web_search_cache(cache_key, question, country_code, domains, openai_client):
+    """Background refresh of a stale web search cache entry."""
+    try:
+        print("Refreshing stale web search result in the background")
+        output_text = fetch_web_search_results(question, country_code, domains, openai_client)
+        web_search_cache.set(cache_key, output_text)
+    except Exception as e:
+        print(f"Background web search refresh failed: {e}")
+    finally:
+        web_search_cache.end_refresh(cache_key)
+
+
+def cache_web_search_results(cache_key, output_text):
+    if WEB_CACHE_ENABLED:
+        try:
+            web_search_cache.set(cache_key, output_text)
+            web_search_cache.delete_older_than(WEB_CACHE_TTL_SECONDS + WEB_CACHE_STALE_SECONDS)
+        except Exception as e:
+            print(f"Error writing the web search cache: {e}")
+
+
+def fetch_and_cache_web_search_results(question, country_code, domains, openai_client, cache_key):
+    output_text = fetch_web_search_results(question, country_code, domains, openai_client)
+    cache_web_search_results(cache_key, output_text)
+    return output_text
+
+
+async def afetch_and_cache_web_search_results(question, country_code, domains, async_openai_client, cache_key):
+    output_text = await afetch_web_search_results(question, country_code, domains, async_openai_client)
+    await asyncio.to_thread(cache_web_search_results, cache_key, output_text)
+    return output_text
+
+
+def get_cached_web_search(cache_key, question, country_code, domains, openai_client):
+    """
+    Return the cached web search result as a Document, or None. Fresh results
+    are returned directly; stale ones are returned while a background thread
+    refreshes them.
+    """
+    if not WEB_CACHE_ENABLED:
+        return None
+    try:
+        cached = web_search_cache.get(cache_key)
+    except Exception as e:
+        print(f"Error reading the web search cache: {e}")
+        cached = None
+    if cached is None:
+        record_event("web_search_cache", status="miss")
+        return None
+    output_text, age = cached
+    if age <= WEB_CACHE_TTL_SECONDS:
+        print(f"Web search cache hit ({age / 3600:.1f} h old)")
+        record_event("web_search_cache", status="fresh", age_seconds=round(age))
+        return Document(page_content="Internet search results: " + output_text)
+    if age <= WEB_CACHE_TTL_SECONDS + WEB_CACHE_STALE_SECONDS:
+        print(f"Web search cache hit, stale ({age / 3600:.1f} h old)")
+        record_event("web_search_cache", status="stale", age_seconds=round(age))
+        if web_search_cache.begin_refresh(cache_key):
+            threading.Thread(
+                target=refresh_web_search_cache,
+                args=(cache_key, question, country_code, domains, openai_client),
+                daemon=True,
+            ).start()
+        return Document(page_content="Internet search results: " + output_text)
+    record_event("web_search_cache", status="expired", age_seconds=round(age))
+    return None
+
+
+def web_search_unavailable():
+    return Document(page_content="Internet search results: Web search is currently unavailable.")
+
+
+def _end_late_web_search(future):
+    global _late_web_searches
+    with _late_web_searches_lock:
+        _late_web_searches -= 1
+
+
+def mark_web_search_late(future):
+    """Count a search that missed its deadline as late until it finishes."""
+    global _late_web_searches
+    with _late_web_searches_lock:
+        _late_web_searches += 1
+    future.add_done_callback(_end_late_web_search)
+
+
+def submit_web_search(fn, *args, timeout=None):
+    """
+    Run fn(*args) on a web search worker, waiting at most `timeout` seconds for
+    a free one. Returns the future, or None if no worker became free in time or
+    all of them are held by searches that already missed their deadline.
+    """
+    with _late_web_searches_lock:
+        if _late_web_searches >= WEB_SEARCH_WORKERS:
+            return None
+    if not _web_search_slots.acquire(timeout=timeout):
+        return None
+    try:
+        future = _web_search_executor.submit(fn, *args)
+    except Exception:
+        _web_search_slots.release()
+        raise
+    future.add_done_callback(lambda _: _web_search_slots.release())
+    return future
+
+
+def fetch_within_deadline(openai_client, question, country_code, domains, cache_key, deadline):
+    """
+    Run the web search on a worker thread and wait for it until the deadline,
+    including the wait for a free worker. Returns the output text, or None if
+    the search missed its deadline (a late result still fills the cache).
+    """
+    start = time.perf_counter()
+    future = submit_web_search(
+        fetch_and_cache_web_search_results, question, country_code, domains, openai_client, cache_key,
+        timeout=deadline)
+    if future is None:
+        print("No web search worker became free before the deadline, continuing without it")
+        record_deadline_miss("web_search")
+        return None
+    remaining = None if deadline is None else max(0.0, deadline - (time.perf_counter() - start))
+    try:
+        return future.result(timeout=remaining)
+    except FuturesTimeoutError:
+        mark_web_search_late(future)
+        print(f"Web search missed its {deadline:.1f}s deadline, continuing without it")
+        record_deadline_miss("web_search")
+        return None
+
+
+def _forget_background_task(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Late web search failed: {task.exception()}")
+
+
+async def afetch_within_deadline(async_openai_client, question, country_code, domains, cache_key, deadline):
+    """Async version of fetch_within_deadline, using the AsyncOpenAI client."""
+    task = asyncio.ensure_future(afetch_and_cache_web_search_results(
+        question, country_code, domains, async_openai_client, cache_key))
+    _background_tasks.add(task)
+    task.add_done_callback(_forget_background_task)
+    try:
+        # shield: a search that misses the deadline keeps running and fills the cache
+        return await asyncio.wait_for(asyncio.shield(task), timeout=deadline)
+    except asyncio.TimeoutError:
+        print(f"Web search missed its {deadline:.1f}s deadline, continuing without it")
+        record_deadline_miss("web_search")
+        return None
+
+
+def web_search_steps(question, country, openai_client, async_openai_client, deadline=None):
+    """
+    Search the trusted domains of a country with OpenAI's web search tool,
+    on the AsyncOpenAI client from async nodes. Fresh cached results are
+    returned directly; stale ones are returned while a background thread
+    refreshes them with openai_client. If the search does not finish within
+    `deadline` seconds, the web results are marked as unavailable (a late
+    result still fills the cache).
+
+    Returns:
+    - Document with the "Internet search results: " (or error) text
+    """
+    try:
+        print(f"Invoking OpenAI web search for {country}...")
         
-        # Construct the query with domain restrictions
-        query = domains_instruction + "\n\n" + original_question
-        
-        # Call OpenAI's web search API
-        response = st.session_state.openai_client.responses.create(
-            model="gpt-4.1",
-            tools=[{
-                "type": "web_search_preview",
-                "user_location": {
-                    "type": "approximate",
-                    "country": country_code
-                }
-            }],
-            input=query
-        )
-        
+        # Configure country-specific settings
+        country_code, domains = get_web_search_settings(country)
+
+        cache_key = WebSearchCache.make_key(country_code, domains, question)
+        cached_doc = yield thread_step(
+            get_cached_web_search, cache_key, question, country_code, domains, openai_client)
+        if cached_doc is not None:
+            return cached_doc
+
+        if deadline is not None and deadline <= 0:
+            print("No latency budget left for the web search, skipping it")
+            record_deadline_miss("web_search")
+            return web_search_unavailable()
+
+        output_text = yield (functools.partial(fetch_within_deadline, openai_client),
+                             functools.partial(afetch_within_deadline, async_openai_client),
+                             (question, country_code, domains, cache_key, deadline))
+        if output_text is None:
+            return web_search_unavailable()
+
         # Process the response
-        web_results = "Internet search results: " + response.output_text
-        web_results_doc = Document(page_content=web_results)
-        documents.append(web_results_doc)
+        web_results = "Internet search results: " + output_text
+        return Document(page_content=web_results)
         
     except Exception as e:
         print(f"Error during OpenAI web search: {e}")
+        record_event("web_search_failed", error=str(e)[:200])
         # Ensure workflow can continue gracefully
-        documents.append(Document(page_content=f"Web search failed: {e}"))
-    
+        return Document(page_content=f"Web search failed: {e}")
+
+
+def web_search_node_steps(state, config=None):
+    runtime = get_runtime(config)
+    original_question = state["question"]
+    documents = state.get("documents", [])
+    documents.append((yield from web_search_steps(
+        original_question, runtime.selected_country, runtime.openai_client,
+        runtime.async_openai_client, deadline=web_search_deadline(state))))
     return {"documents": documents, "question": original_question}
 
 
-def hybrid_search(state):
-    question = state["question"]
+def web_search(state, config=None):
+    return run_steps(web_search_node_steps(state, config))
+
+
+async def aweb_search(state, config=None):
+    return await arun_steps(web_search_node_steps(state, config))
+
+
+def hybrid_search(state, config=None):
+    """Fan-out point of hybrid search: vector_branch and web_branch run in parallel after it."""
     print("Invoking hybrid search...")
+    return {"branch_documents": []}
+
+
+def label_vector_results(filtered_vector_docs):
+    # Add headings to distinguish between vector and web search results
+    vector_results = [Document(
+        page_content="Smart guide results: " + doc.page_content,
+        metadata={"branch": "vector"}) for doc in filtered_vector_docs]
+    return {"branch_documents": vector_results}
+
+
+# Vector retrieval in hybrid search is retried on transient errors. Only the
+# retrieval: retrying the whole branch would repeat paid grading calls
+VECTOR_RETRIEVAL_ATTEMPTS = 2
+
+
+def retrieve_with_retry_steps(retriever, question):
+    for attempt in range(1, VECTOR_RETRIEVAL_ATTEMPTS + 1):
+        try:
+            return (yield invoke_step(retriever, question))
+        except Exception as e:
+            if attempt == VECTOR_RETRIEVAL_ATTEMPTS:
+                raise
+            print(f"Vector retrieval failed, retrying: {e}")
+
+
+def vector_branch_steps(state, config=None):
+    """Hybrid search branch: retrieve and grade the Smart guide chunks."""
+    runtime = get_runtime(config)
+    question = state["question"]
     
     # For Finland, do hybrid search
-    vector_docs = st.session_state.retriever.invoke(question)
+    vector_docs = yield from retrieve_with_retry_steps(runtime.retriever, question)
     
     # Grade the vector documents
-    filtered_vector_docs = grade_retriever_hybrid(vector_docs, question)
-    
-    # Add headings to distinguish between vector and web search results
-    vector_results = [Document(
-        page_content="Smart guide results: " + doc.page_content) for doc in filtered_vector_docs]
+    return label_vector_results((yield from grade_retriever_hybrid_steps(runtime, vector_docs, question)))
 
-    # Proceed with web search
-    web_docs = web_search({"question": question})["documents"]
-    
+
+def vector_branch(state, config=None):
+    return run_steps(vector_branch_steps(state, config))
+
+
+async def avector_branch(state, config=None):
+    return await arun_steps(vector_branch_steps(state, config))
+
+
+def label_web_results(web_docs):
     # Check if any web_docs already contain "Internet search results:"
     web_results_contain_header = any(
         "Internet search results:" in doc.page_content for doc in web_docs)
 
     # Add "Internet search results:" only if not already present in any web doc
     if not web_results_contain_header:
-        web_results = [
+        web_docs = [
             Document(page_content="Internet search results:" + doc.page_content) for doc in web_docs
         ]
-    else:
-        web_results = web_docs  # Keep web_docs unchanged if they already contain the header
+    web_results = [
+        Document(page_content=doc.page_content, metadata={"branch": "web"}) for doc in web_docs]
+    return {"branch_documents": web_results}
+
+
+def web_branch_steps(state, config=None):
+    """Hybrid search branch: search the trusted web domains."""
+    runtime = get_runtime(config)
+    question = state["question"]
+    return label_web_results([(yield from web_search_steps(
+        question, runtime.selected_country, runtime.openai_client,
+        runtime.async_openai_client, deadline=web_search_deadline(state)))])
+
+
+def web_branch(state, config=None):
+    return run_steps(web_branch_steps(state, config))
+
+
+async def aweb_branch(state, config=None):
+    return await arun_steps(web_branch_steps(state, config))
+
+
+def hybrid_join(state, config=None):
+    """Merge the branch results: Smart guide results first, then web results."""
+    question = state["question"]
+    branch_documents = state.get("branch_documents", [])
+    vector_results = [doc for doc in branch_documents if doc.metadata.get("branch") == "vector"]
+    web_results = [doc for doc in branch_documents if doc.metadata.get("branch") != "vector"]
 
     # Combine the filtered vector results with web results
     combined_docs = vector_results + web_results
     return {"documents": combined_docs, "question": question}
 
 
-# Router function
-def route_question(state):
-    question = state["question"]    
-    hybrid_search_enabled = state.get("hybrid_search", False)
-    internet_search_enabled = state.get("internet_search", False)
-    
-    country = st.session_state.selected_country
+# Process-wide pre-router state, keyed by embedding model: the local
+# sentence-transformers model, then one embedder and one set of centroids per model
+_pre_router_lock = threading.Lock()
+_pre_router_local_model = None  # False once loading it has failed
+_pre_router_embedders = {}
+_pre_router_centroids = {}
+
+
+def get_pre_router_embedder(fallback_embed_model=None):
+    """
+    Return (model_key, embed) where embed maps a list of texts to L2-normalized
+    vectors. Uses a small local sentence-transformers model, falling back to the
+    session's embedding model (fallback_embed_model) if that runs locally too.
+    Returns None when no local embedder is available: a remote embedding API
+    would cost a network round trip per question, so the LLM router decides.
+    """
+    global _pre_router_local_model
+    with _pre_router_lock:
+        if _pre_router_local_model is None:
+            try:
+                if FAKE_BACKENDS_ENABLED:
+                    raise RuntimeError("fake backends enabled, not loading local models")
+                _pre_router_local_model = SentenceTransformer(PRE_ROUTER_MODEL, device="cpu")
+                print(f"Pre-router using local model {PRE_ROUTER_MODEL}")
+            except Exception as e:
+                print(f"Could not load pre-router model {PRE_ROUTER_MODEL}: {e}")
+                _pre_router_local_model = False
+
+        if _pre_router_local_model is not False:
+            model_key = PRE_ROUTER_MODEL
+            if model_key not in _pre_router_embedders:
+                model = _pre_router_local_model
+                _pre_router_embedders[model_key] = lambda texts: model.encode(
+                    texts, normalize_embeddings=True)
+            return model_key, _pre_router_embedders[model_key]
+
+        embed_model = fallback_embed_model
+        if not isinstance(embed_model, (HuggingFaceEmbeddings, HashEmbeddings)):
+            return None
+        model_key = getattr(embed_model, "model_name", type(embed_model).__name__)
+        if model_key not in _pre_router_embedders:
+            def _embed(texts):
+                vectors = np.asarray(embed_model.embed_documents(texts), dtype=np.float32)
+                return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+            _pre_router_embedders[model_key] = _embed
+        return model_key, _pre_router_embedders[model_key]
+
+
+def get_pre_router_centroids(model_key, embed):
+    """Compute (once per embedding model) the normalized centroid of each pre-router example group."""
+    with _pre_router_lock:
+        if model_key not in _pre_router_centroids:
+            centroids = {}
+            for label, examples in pre_router_examples.items():
+                centroid = np.asarray(embed(examples), dtype=np.float32).mean(axis=0)
+                centroids[label] = centroid / np.linalg.norm(centroid)
+            _pre_router_centroids[model_key] = centroids
+    return _pre_router_centroids[model_key]
+
+
+def pre_route_question(question, country, fallback_embed_model=None):
+    """
+    Answer obvious questions about the selected country locally by comparing
+    the question embedding with the example centroids. Rejections (unrelated
+    or another country) are never decided here: a question naming no country
+    is about the selected country, which the centroids cannot tell.
+
+    Returns:
+    - (True, False) when the question is confidently about the selected country
+    - None when the LLM router should decide
+    """
+    try:
+        start = time.perf_counter()
+        embedder = get_pre_router_embedder(fallback_embed_model)
+        if embedder is None:
+            return None
+        model_key, embed = embedder
+        thresholds = PRE_ROUTER_THRESHOLDS.get(model_key)
+        if thresholds is None:
+            print(f"No pre-router thresholds for {model_key}, asking the LLM router")
+            return None
+        centroids = get_pre_router_centroids(model_key, embed)
+        query = np.asarray(embed([question]), dtype=np.float32)[0]
+        scores = {label: float(np.dot(query, centroid)) for label, centroid in centroids.items()}
+    except Exception as e:
+        print(f"Error in pre-router, falling back to the LLM router: {e}")
+        return None
+
+    own_label = f"business/{country}"
+    best_label = max(scores, key=scores.get)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f"Pre-router scores: {scores} ({elapsed_ms:.1f} ms)")
+    if best_label != own_label:
+        print("Pre-router leaves the rejection to the LLM router")
+        return None
+
+    margin = scores[own_label] - max(score for label, score in scores.items() if label != own_label)
+    if scores[own_label] < thresholds["min_similarity"] or margin < thresholds["min_margin"]:
+        print("Pre-router not confident, asking the LLM router")
+        return None
+
+    print(f"Pre-router decided locally: {own_label}")
+    return True, False
+
+
+class RouteDecision(BaseModel):
+    """Combined router verdict for a user question."""
+    business_related: bool = Field(
+        description="Question is broadly related to business, entrepreneurship, or economic activities"
+    )
+    other_country: bool = Field(
+        description="Question is explicitly about a country or city other than the selected country"
+    )
+    suggested_route: Literal["answer", "unrelated"] = Field(
+        description="'unrelated' if the question is not business-related or about another country, otherwise 'answer'"
+    )
+
+
+def classify_question_steps(question, router_chain):
+    """
+    Answer both router checks with a single structured-output call.
+
+    Returns:
+    - RouteDecision (falls back to a business-related, same-country decision on errors)
+    """
+    try:
+        decision = yield invoke_step(router_chain, {"question": question})
+        print(f"Router decision: {decision}")
+        if (decision.suggested_route == "unrelated") != (decision.other_country or not decision.business_related):
+            print("Router suggested_route disagrees with its checks, using the checks")
+        return decision
+    except Exception as e:
+        print(f"Error in structured router: {e}")
+        record_event("router_fallback", check="structured", error=str(e)[:200])
+        # Same defaults as the individual yes/no checks
+        return RouteDecision(business_related=True, other_country=False, suggested_route="answer")
+
+
+def is_unrelated(business_related, different_country):
+    """The question is unrelated if it is not business-related or about a different country."""
+    return different_country or not business_related
+
+
+def run_router_checks_concurrently(question, router_chains):
+    """
+    Run the business and country checks of the router at the same time.
 
+    As soon as one finished check already decides that the question is unrelated
+    (not business-related, or about a different country), the other check is
+    cancelled and no longer waited for.
+
+    Returns:
+    - (business_related, different_country)
+    """
+    # Defaults match the error fallbacks of the individual checks
+    business_related, different_country = True, False
+
+    executor = ContextThreadPoolExecutor(max_workers=2)
+    business_future = executor.submit(run_steps, router_check_steps(router_chains, "business", question))
+    country_future = executor.submit(run_steps, router_check_steps(router_chains, "country", question))
+    pending = {business_future, country_future}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if business_future in done:
+                business_related = business_future.result()
+            if country_future in done:
+                different_country = country_future.result()
+
+            if pending and is_unrelated(business_related, different_country):
+                print("Router outcome decided early, cancelling the remaining check")
+                for future in pending:
+                    future.cancel()
+                break
+    finally:
+        # Do not block on a check whose result is no longer needed
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return business_related, different_country
+
+
+async def arun_router_checks_concurrently(question, router_chains):
+    """
+    Async version of run_router_checks_concurrently. A check that is no longer
+    needed is cancelled, which also aborts its in-flight request.
+    """
+    business_related, different_country = True, False
+
+    business_task = asyncio.ensure_future(arun_steps(router_check_steps(router_chains, "business", question)))
+    country_task = asyncio.ensure_future(arun_steps(router_check_steps(router_chains, "country", question)))
+    pending = {business_task, country_task}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if business_task in done:
+                business_related = business_task.result()
+            if country_task in done:
+                different_country = country_task.result()
+
+            if pending and is_unrelated(business_related, different_country):
+                print("Router outcome decided early, cancelling the remaining check")
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return business_related, different_country
+
+
+# Process-wide registry of precompiled router chains, keyed by (country, router model)
+_router_registry = {}
+_router_registry_lock = threading.Lock()
+
+
+def build_router_prompts(country):
+    """
+    Build the router prompts for one country. The long system message comes
+    first and is identical for every question, so provider-side prompt caching
+    can reuse it; only the human message carries the question.
+    """
     # Merged business topics and tool selection criteria
     business_topics = (
         f"Questions related to business, startups, and practical aspects of operating in {country}, including but not limited to: "
@@ -960,42 +2219,70 @@ def route_question(state):
         ("human", "Question: {question}")
     ])
     
-    # Function to check business topic relevance
-    def is_business_related(q):
-        try:
-            result = (business_relevance_prompt | st.session_state.router_llm | StrOutputParser()).invoke({"question": q})
-            return "yes" in result.lower()
-        except Exception as e:
-            print(f"Error in business relevance check: {e}")
-            # Default to True in case of error
-            return True
-    
-    # Function to check if question is about a different country/city
-    def is_wrong_country(q):
-        try:
-            result = (country_relevance_prompt | st.session_state.router_llm | StrOutputParser()).invoke({"question": q})
-            return "yes" in result.lower()
-        except Exception as e:
-            print(f"Error in country relevance check: {e}")
-            # Default to False in case of error
-            return False
-    
-    # Check both conditions separately
-    business_related = is_business_related(question)
-    different_country = is_wrong_country(question)
-    
+    combined_router_prompt = ChatPromptTemplate.from_messages([
+        ("system", f"""You are the router of a business guide for {country}. Classify the user question with two independent checks.
+
+        1. business_related: Is the question broadly related to business, entrepreneurship, or economic activities?
+        Use an INCLUSIVE approach:
+        - True if the question relates to ANY aspect of starting, running, managing, or closing businesses or startups
+        - True if the question COULD be asked by someone interested in entrepreneurship
+        - True if the question relates to topics that entrepreneurs or business people commonly need to know
+        - True if the question involves economic activities, work, income, or finances
+        - True if the question is about living, working, or operating in a country from a practical standpoint
+        - True even if the business connection is implicit rather than explicit
+        - True if you're uncertain but the question could reasonably have a business angle
+        Only False if the question is CLEARLY unrelated to business, entrepreneurship, economics, work, or practical aspects of living in a country.
+
+        Here are example topics that should be considered business-related:
+        {business_topics}
+
+        2. other_country: Is the question explicitly about a country OTHER THAN {country} or a city that is NOT in {country}?
+        If no country is explicitly mentioned, the question is about {country} and other_country is False.
+
+        3. suggested_route: 'unrelated' if business_related is False or other_country is True, otherwise 'answer'.
+        """),
+        ("human", "Question: {question}")
+    ])
+
+    return {
+        "business": business_relevance_prompt,
+        "country": country_relevance_prompt,
+        "combined": combined_router_prompt,
+    }
+
+
+def get_router_chains(country, router_llm):
+    """
+    Return the router chains for a country and router model, building them
+    on first use and reusing them across questions and sessions.
+    """
+    key = (country, getattr(router_llm, "model_name", type(router_llm).__name__))
+    with _router_registry_lock:
+        if key not in _router_registry:
+            print(f"Building router chains for {country} with {key[1]}")
+            prompts = build_router_prompts(country)
+            _router_registry[key] = {
+                "business": prompts["business"] | router_llm | StrOutputParser(),
+                "country": prompts["country"] | router_llm | StrOutputParser(),
+                "structured": prompts["combined"] | router_llm.with_structured_output(RouteDecision),
+            }
+        return _router_registry[key]
+
+
+def select_route(country, business_related, different_country, hybrid_search_enabled, internet_search_enabled):
+    """Map the router checks and the search options to the name of the next node."""
     # If question is about a different country or not business-related, mark as unrelated
-    if different_country or not business_related:
+    if is_unrelated(business_related, different_country):
         print(f"Question is {'about a different country' if different_country else 'not related to business topics'}, marking as unrelated")
         return "unrelated"
     
     # Now we know the question is business-related and not about a different country
     # For Estonia, always use web search for relevant questions
-    if st.session_state.selected_country == "Estonia":
+    if country == "Estonia":
         return "websearch"
 
     # For Finland with hybrid or internet search enabled
-    if st.session_state.selected_country == "Finland":
+    if country == "Finland":
         if hybrid_search_enabled:
             return "hybrid_search"
         elif internet_search_enabled:
@@ -1007,41 +2294,180 @@ def route_question(state):
     return "retrieve"
 
 
-workflow = StateGraph(GraphState)
-# # Add nodes
-workflow.add_node("retrieve", retrieve)
-workflow.add_node("grade_documents", grade_documents)
-workflow.add_node("route_after_grading", route_after_grading)
-workflow.add_node("websearch", web_search)
-workflow.add_node("generate", generate)
-workflow.add_node("hybrid_search", hybrid_search)
-workflow.add_node("unrelated", handle_unrelated)
-
-# Set conditional entry points
-workflow.set_conditional_entry_point(
-    route_question,
-    {
-        "retrieve": "retrieve",
-        "websearch": "websearch",
-        "hybrid_search": "hybrid_search",
-        "unrelated": "unrelated"
-    },
-)
+# Yes/no router checks: name and verdict in case of error
+router_checks = {
+    "business": ("business relevance", True),  # question is business-related
+    "country": ("country relevance", False),  # question is about a different country/city
+}
 
-# Add edges
-workflow.add_edge("retrieve", "grade_documents")
-workflow.add_conditional_edges(
-    "grade_documents",
-    route_after_grading,
-    {"websearch": "websearch", "generate": "generate"},
-)
-workflow.add_edge("websearch", "generate")
-workflow.add_edge("hybrid_search", "generate")
-workflow.add_edge("unrelated", "generate")
+
+def router_check_steps(router_chains, check, question):
+    """Run a yes/no router check ("business" or "country"). Returns its default on errors."""
+    check_name, default = router_checks[check]
+    try:
+        result = yield invoke_step(router_chains[check], {"question": question})
+        return "yes" in result.lower()
+    except Exception as e:
+        print(f"Error in {check_name} check: {e}")
+        record_event("router_fallback", check=check_name, error=str(e)[:200])
+        return default
+
+
+# Router function
+def route_question_steps(state, config=None):
+    runtime = get_runtime(config)
+    question = state["question"]    
+    hybrid_search_enabled = state.get("hybrid_search", False)
+    internet_search_enabled = state.get("internet_search", False)
+    
+    country = runtime.selected_country
+
+    # Obvious questions about the selected country skip the LLM router
+    if PRE_ROUTER_ENABLED:
+        local_decision = yield thread_step(pre_route_question, question, country, runtime.embed_model)
+        if local_decision is not None:
+            return select_route(country, *local_decision, hybrid_search_enabled, internet_search_enabled)
+
+    # Prompts and chains are precompiled once per country and router model
+    router_chains = get_router_chains(country, runtime.router_llm)
+
+    if ROUTER_MODE == "structured":
+        decision = yield from classify_question_steps(question, router_chains["structured"])
+        business_related = decision.business_related
+        different_country = decision.other_country
+    elif ROUTER_MODE == "concurrent":
+        business_related, different_country = yield (
+            run_router_checks_concurrently, arun_router_checks_concurrently, (question, router_chains))
+    else:
+        # Check both conditions separately
+        business_related = yield from router_check_steps(router_chains, "business", question)
+        different_country = yield from router_check_steps(router_chains, "country", question)
+    
+    return select_route(country, business_related, different_country,
+                        hybrid_search_enabled, internet_search_enabled)
+
+
+def route_question(state, config=None):
+    return run_steps(route_question_steps(state, config))
+
+
+async def aroute_question(state, config=None):
+    """Async version of route_question. The local pre-router runs in a worker thread."""
+    return await arun_steps(route_question_steps(state, config))
+
+
+def build_workflow():
+    """Build the (uncompiled) RAG graph. Nodes take all per-question settings from the state and config."""
+    workflow = StateGraph(GraphState)
+    # # Add nodes (each with a sync and, where it does I/O, an async implementation)
+    workflow.add_node("retrieve", graph_node("retrieve", retrieve, aretrieve, stage="retrieve"))
+    workflow.add_node("grade_documents", graph_node("grade_documents", grade_documents, agrade_documents, stage="grade"))
+    workflow.add_node("route_after_grading", route_after_grading)
+    workflow.add_node("websearch", graph_node("websearch", web_search, aweb_search))
+    workflow.add_node("generate", graph_node("generate", generate, agenerate, stage="generate"))
+    workflow.add_node("hybrid_search", graph_node("hybrid_search", hybrid_search))
+    workflow.add_node("vector_branch", graph_node("vector_branch", vector_branch, avector_branch, stage="retrieve"))
+    workflow.add_node("web_branch", graph_node("web_branch", web_branch, aweb_branch))
+    workflow.add_node("hybrid_join", graph_node("hybrid_join", hybrid_join))
+    workflow.add_node("unrelated", graph_node("unrelated", handle_unrelated))
+
+    # Set conditional entry points
+    workflow.set_conditional_entry_point(
+        graph_node("route_question", route_question, aroute_question, stage="route"),
+        {
+            "retrieve": "retrieve",
+            "websearch": "websearch",
+            "hybrid_search": "hybrid_search",
+            "unrelated": "unrelated"
+        },
+    )
+
+    # Add edges
+    workflow.add_edge("retrieve", "grade_documents")
+    workflow.add_conditional_edges(
+        "grade_documents",
+        route_after_grading,
+        {"websearch": "websearch", "generate": "generate"},
+    )
+    workflow.add_edge("websearch", "generate")
+    # Hybrid search fans out into two branches that run in the same superstep
+    workflow.add_edge("hybrid_search", "vector_branch")
+    workflow.add_edge("hybrid_search", "web_branch")
+    workflow.add_edge(["vector_branch", "web_branch"], "hybrid_join")
+    workflow.add_edge("hybrid_join", "generate")
+    workflow.add_edge("unrelated", "generate")
+
+    return workflow
+
+
+# The compiled graph only depends on the graph topology, not on the session or the
+# question, so it is compiled once per process and shared; per-request settings
+# are injected through the input state and config["configurable"]
+_compiled_workflow = None
+_compiled_workflow_lock = threading.Lock()
+
+
+def get_compiled_workflow():
+    """Return the shared compiled workflow, compiling it on first use."""
+    global _compiled_workflow
+    with _compiled_workflow_lock:
+        if _compiled_workflow is None:
+            print("Compiling the RAG workflow")
+            _compiled_workflow = build_workflow().compile()
+        return _compiled_workflow
 
 
 # Compile app
-app = workflow.compile()
+app = get_compiled_workflow()
+
+
+# Process-wide event loop for the async workflow (app.ainvoke / app.astream).
+# Async API clients are bound to the loop they first ran on, so all async
+# runs share this one long-lived loop instead of a new loop per question.
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Return the background event loop, starting its thread on first use."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="rag_event_loop", daemon=True).start()
+            _event_loop = loop
+    return _event_loop
+
+
+def run_async(coroutine):
+    """Run a coroutine on the background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+def iterate_async(async_iterable):
+    """
+    Iterate an async iterable, e.g. app.astream(...), from synchronous code.
+    The iteration runs on the background event loop, so many questions can be
+    in flight at once while each caller thread only waits for its own items.
+    """
+    items = queue.Queue()
+    end = object()
+
+    async def consume():
+        try:
+            async for item in async_iterable:
+                items.put(item)
+        finally:
+            items.put(end)
+
+    future = asyncio.run_coroutine_threadsafe(consume(), get_event_loop())
+    try:
+        while (item := items.get()) is not end:
+            yield item
+        # Re-raise errors of the async iteration
+        future.result()
+    finally:
+        future.cancel()
 
 
 
@@ -0,0 +1,191 @@
+"""
+Headless HTTP API for the Smart Guide RAG workflow, for frontends other than
+the Streamlit app.
+
+Endpoints:
+    POST /ask        Answer one question as server-sent events: "token" events
+                     while the answer is generated, then a "done" event with
+                     the full answer, its route and timing (or an "error" event).
+    POST /ask/batch  Answer several questions concurrently; returns JSON.
+    GET  /health     Liveness check for load balancers.
+    GET  /metrics    Prometheus metrics of this server process (see metrics.py).
+
+Every request selects its own country, answer style, search mode and models.
+Questions run on the async workflow (app.astream_events); at most
+API_MAX_CONCURRENT_RUNS run at once per server process and the others wait
+for a free slot.
+
+Usage:
+    uvicorn api_server:app --host 0.0.0.0 --port 8000 --workers 2
+"""
+import asyncio
+import json
+import os
+import time
+from functools import lru_cache
+from typing import List, Literal, Optional
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from prometheus_client import make_asgi_app
+from pydantic import BaseModel, Field, field_validator
+
+import metrics
+from agentic_rag import create_runtime, get_compiled_workflow, model_list
+from telemetry import TurnTelemetry, write_log
+
+# Questions processed at the same time by one server process
+API_MAX_CONCURRENT_RUNS = int(os.environ.get("API_MAX_CONCURRENT_RUNS", "16"))
+API_MAX_BATCH_SIZE = 50
+API_MAX_QUESTION_CHARS = 2000
+
+# Same defaults as the Streamlit app
+DEFAULT_ANSWERING_MODEL = "gpt-4.1-2025-04-14"
+DEFAULT_ROUTING_MODEL = "gpt-4.1-2025-04-14"
+DEFAULT_GRADING_MODEL = "gpt-4.1-2025-04-14"
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-large"
+
+# Only the embedding model the stored vector index was built with
+embedding_models = ["text-embedding-3-large"]
+
+app = FastAPI(title="Smart Guide API")
+app.mount("/metrics", make_asgi_app())
+workflow_app = get_compiled_workflow()
+_run_slots = asyncio.Semaphore(API_MAX_CONCURRENT_RUNS)
+
+
+class AskRequest(BaseModel):
+    question: str = Field(min_length=1, max_length=API_MAX_QUESTION_CHARS)
+    country: Literal["Finland", "Estonia"] = "Finland"
+    answer_style: Literal["Concise", "Moderate", "Explanatory"] = "Concise"
+    # "documents": Smart guide documents, "web": trusted web sources, "hybrid": both (Finland only;
+    # Estonia always uses web search)
+    search_mode: Literal["documents", "web", "hybrid"] = "hybrid"
+    answering_model: str = DEFAULT_ANSWERING_MODEL
+    routing_model: str = DEFAULT_ROUTING_MODEL
+    grading_model: str = DEFAULT_GRADING_MODEL
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL
+
+    @field_validator("answering_model", "routing_model", "grading_model")
+    @classmethod
+    def check_model(cls, value):
+        if value not in model_list:
+            raise ValueError(f"unknown model, choose one of: {', '.join(model_list)}")
+        return value
+
+    @field_validator("embedding_model")
+    @classmethod
+    def check_embedding_model(cls, value):
+        if value not in embedding_models:
+            raise ValueError(f"unknown embedding model, choose one of: {', '.join(embedding_models)}")
+        return value
+
+
+class BatchAskRequest(BaseModel):
+    requests: List[AskRequest] = Field(min_length=1, max_length=API_MAX_BATCH_SIZE)
+
+
+class AskResult(BaseModel):
+    question: str
+    answer: str = ""
+    route: Optional[str] = None
+    elapsed_seconds: float = 0.0
+    error: Optional[str] = None
+
+
+@lru_cache(maxsize=32)
+def get_request_runtime(country, answering_model, embedding_model, routing_model, grading_model, answer_style):
+    """Runtimes are read-only for the nodes, so requests with the same settings share one."""
+    return create_runtime(country, answering_model, embedding_model, routing_model,
+                          grading_model, answer_style)
+
+
+async def ask_events(request):
+    """
+    Run the workflow for one request. Yields ("token", text) while the answer
+    is generated and finally ("done", AskResult).
+    """
+    async with _run_slots:
+        start = time.time()
+        result = AskResult(question=request.question)
+        telemetry = TurnTelemetry(question=request.question, source="api",
+                                  **request.model_dump(exclude={"question"}))
+        try:
+            # The first request for a model or vector store loads it, which blocks
+            runtime = await asyncio.to_thread(
+                get_request_runtime, request.country, request.answering_model,
+                request.embedding_model, request.routing_model, request.grading_model,
+                request.answer_style)
+            inputs = {
+                "question": request.question,
+                "hybrid_search": request.search_mode == "hybrid",
+                "internet_search": request.search_mode == "web",
+                "answer_style": request.answer_style,
+                "started_at": start,
+            }
+            config = {"callbacks": [telemetry], "configurable": {"runtime": runtime}}
+
+            streamed = False
+            async for event in workflow_app.astream_events(inputs, config=config, version="v2"):
+                node = event.get("metadata", {}).get("langgraph_node")
+                if event["event"] == "on_chat_model_stream" and node == "generate":
+                    text = event["data"]["chunk"].content
+                    if text:
+                        streamed = True
+                        yield "token", text
+                elif event["event"] == "on_chain_end" and event["name"] == "route_question":
+                    result.route = event["data"].get("output")
+                elif event["event"] == "on_chain_end" and event["name"] == "generate":
+                    output = event["data"].get("output")
+                    if isinstance(output, dict) and "generation" in output:
+                        result.answer = output["generation"]
+
+            # Fixed answers (unrelated questions, errors) are not generated token by token
+            if not streamed and result.answer:
+                yield "token", result.answer
+        except Exception as e:
+            print(f"Error answering question via the API: {e}")
+            metrics.record_error("api")
+            result.error = str(e)
+        result.elapsed_seconds = round(time.time() - start, 3)
+        telemetry.finish(failed=result.error is not None)
+        write_log(telemetry.summary())
+        yield "done", result
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/ask")
+async def ask(request: AskRequest):
+    async def event_stream():
+        async for kind, value in ask_events(request):
+            if kind == "token":
+                yield format_sse("token", {"text": value})
+            elif value.error:
+                yield format_sse("error", value.model_dump())
+            else:
+                yield format_sse("done", value.model_dump())
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def answer(request):
+    result = None
+    async for kind, value in ask_events(request):
+        if kind == "done":
+            result = value
+    return result
+
+
+@app.post("/ask/batch", response_model=List[AskResult])
+async def ask_batch(batch: BatchAskRequest):
+    # The questions share the server's run slots with all other requests
+    return await asyncio.gather(*(answer(request) for request in batch.requests))
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "max_concurrent_runs": API_MAX_CONCURRENT_RUNS}
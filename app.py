@@ -5,18 +5,19 @@ try:
     print("Using pysqlite3 module instead of sqlite3 (Rahti compatible)")
 except ImportError:
     print("pysqlite3 not found, using standard sqlite3 module (local development)")
-import io
 import re
-import sys
 import time
 
 import streamlit as st
 import torch
 import tornado
-from langchain_openai import ChatOpenAI
 
-from agentic_rag import initialize_app
+from agentic_rag import (get_latency_metrics, get_shared_model, initialize_app,
+                         iterate_async, run_async, runtime_from_session_state)
+import metrics
+from rag_cache import AnswerCache, SemanticAnswerCache
 from st_callback import get_streamlit_cb
+from telemetry import TurnTelemetry, write_log
 
 # This code line below Fixes console "RuntimeError: Tried to instantiate class '__path__._path', but it does not exist!"
 # reference: https://github.com/VikParuchuri/marker/issues/442#issuecomment-2636393925
@@ -43,7 +44,81 @@ if "followup_questions" not in st.session_state:
 if "show_guidelines" not in st.session_state:
     st.session_state.show_guidelines = False
 
+# Run the workflow with app.astream on the shared event loop (async nodes), so
+# concurrent sessions overlap their I/O; False uses the blocking app.stream
+USE_ASYNC_WORKFLOW = True
+
+# Exact-match answer cache, shared by all sessions of the server process
+ANSWER_CACHE_MAX_ENTRIES = 500
+ANSWER_CACHE_TTL_SECONDS = 6 * 3600
+CACHED_ANSWER_WORDS_PER_CHUNK = 12  # cached answers are replayed in chunks of this many words
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+
+# Semantic answer cache: paraphrased questions reuse earlier answers
+SEMANTIC_CACHE_THRESHOLD = 0.92  # cosine similarity of the question embeddings
+SEMANTIC_CACHE_MAX_ENTRIES = 1000  # per country / answer style / search mode
+SEMANTIC_CACHE_TTL_SECONDS = 24 * 3600
+SEMANTIC_CACHE_WEB_TTL_SECONDS = 3600  # web search results go stale faster
+
+@st.cache_resource
+def get_semantic_cache():
+    return SemanticAnswerCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES)
+
+# Prometheus metrics on METRICS_PORT (env, default 9464), next to the Streamlit server
+metrics.start_metrics_server()
+
 # -------------------- Helper Functions --------------------
+def get_search_mode():
+    """Name of the search option currently selected in the sidebar."""
+    if st.session_state.hybrid_search:
+        return "Reliable docs & web sources"
+    if st.session_state.internet_search:
+        return "Reliable web sources"
+    return "Reliable documents"
+
+
+def lookup_semantic_cache(question, scope):
+    """
+    Embed the question with the configured embedding model and look for an
+    answer to a similar question in the semantic cache.
+
+    Returns:
+    - (cached answer or None, question embedding or None)
+    """
+    try:
+        lookup_start = time.time()
+        embedding = st.session_state.embed_model.embed_query(question)
+        match = get_semantic_cache().get(scope, embedding, time.time() - lookup_start)
+    except Exception as e:
+        print(f"Semantic cache lookup failed: {e}")
+        return None, None
+    if match is None:
+        return None, embedding
+    answer, similarity = match
+    print(f"Semantic cache hit (similarity {similarity:.3f}), replaying the cached answer")
+    return answer, embedding
+
+
+def stream_cached_answer(answer, response_placeholder):
+    """Replay a cached answer chunk by chunk so it appears like a streamed response."""
+    words = answer.split(" ")
+    for end in range(CACHED_ANSWER_WORDS_PER_CHUNK, len(words) + CACHED_ANSWER_WORDS_PER_CHUNK,
+                     CACHED_ANSWER_WORDS_PER_CHUNK):
+        styled_response = re.sub(
+            r'\[(.*?)\]',
+            r'<span class="reference">[\1]</span>',
+            " ".join(words[:end])
+        )
+        response_placeholder.markdown(
+            f"**Assistant:** {styled_response}",
+            unsafe_allow_html=True
+        )
+        time.sleep(0.005)
+
+
 def get_followup_questions(last_user, last_assistant):
     """
     Generate three concise follow-up questions dynamically based on the latest conversation.
@@ -58,7 +133,7 @@ Follow-up Questions:"""
         # Use ChatOpenAI as a fallback if the selected models because otherwise it will fail. e.g Gemma might not support invoking method.
         if any(model_type in st.session_state.selected_model.lower()
                for model_type in ["gemma2", "deepseek", "mixtral"]):
-            fallback_llm = ChatOpenAI(model=model_default, temperature=0.5)
+            fallback_llm = get_shared_model("openai", model_default, temperature=0.5)
             response = fallback_llm.invoke(prompt)
         else:
             response = st.session_state.llm.invoke(prompt)
@@ -71,11 +146,52 @@ Follow-up Questions:"""
         return []
 
 
+def web_search_degraded(events):
+    """True if the web search of a turn failed or was cut off at its deadline."""
+    return any(event["name"] == "web_search_failed"
+               or (event["name"] == "deadline_miss" and event.get("stage") == "web_search")
+               for event in events)
+
+
+def show_telemetry(turn_telemetry):
+    """Collapsible breakdown of one answer: node and model call timings, tokens, cache hits and fallbacks."""
+    with st.expander(f"⏱️ Timing breakdown ({turn_telemetry['total_seconds']:.2f} s)", expanded=False):
+        if turn_telemetry["nodes"]:
+            st.markdown("**Workflow steps**")
+            st.table([{
+                "step": node["name"],
+                "start (s)": node["start_s"],
+                "duration (s)": node["seconds"],
+                "error": node.get("error", ""),
+            } for node in turn_telemetry["nodes"]])
+        if turn_telemetry["llm_calls"]:
+            st.markdown("**Model calls**")
+            st.table([{
+                "step": call["node"] or "",
+                "model": call["model"] or "",
+                "duration (s)": call["seconds"],
+                "first token (s)": call.get("first_token_s", ""),
+                "prompt tokens": call["prompt_tokens"] if call.get("prompt_tokens") is not None else "",
+                "completion tokens": call["completion_tokens"] if call.get("completion_tokens") is not None else "",
+            } for call in turn_telemetry["llm_calls"]])
+        if turn_telemetry["events"]:
+            st.markdown("**Cache hits and fallbacks**")
+            for event in turn_telemetry["events"]:
+                details = ", ".join(f"{key}: {value}" for key, value in event.items()
+                                    if key not in ("name", "at_s") and value is not None)
+                st.markdown(f"- `{event['name']}` at {event['at_s']:.2f} s {f'({details})' if details else ''}")
+        tokens = turn_telemetry["tokens"]
+        st.caption(f"Route: {turn_telemetry['route'] or '-'} · Tokens: {tokens['prompt']} prompt, "
+                   f"{tokens['completion']} completion"
+                   f"{' · Fallback used' if turn_telemetry['fallback_used'] else ''}")
+
+
 def process_question(question, answer_style):
     """
     Process a question (typed or follow-up):
       1. Append as a user message.
-      2. Run the RAG workflow (via app.stream) and stream the assistant's response.
+      2. Run the RAG workflow (via app.astream, or app.stream if USE_ASYNC_WORKFLOW
+         is off) and stream the assistant's response.
          If streaming produces no content (or errors occur), a fallback non-streaming
          approach is attempted.
     """
@@ -84,9 +200,17 @@ def process_question(question, answer_style):
     with st.chat_message("user"):
         st.markdown(f"**You:** {question}")
 
-    # Redirect stdout for debugging
-    output_buffer = io.StringIO()
-    sys.stdout = output_buffer
+    # Node and model timings, token counts, cache hits and fallbacks of this turn
+    telemetry = TurnTelemetry(
+        question=question,
+        country=st.session_state.selected_country,
+        answer_style=answer_style,
+        search_mode=get_search_mode(),
+        answering_model=st.session_state.selected_model,
+        routing_model=st.session_state.selected_routing_model,
+        grading_model=st.session_state.selected_grading_model,
+        embedding_model=st.session_state.selected_embedding_model,
+    )
     assistant_response = ""
 
     # 2) Initialize empty assistant message for streaming the response
@@ -95,94 +219,160 @@ def process_question(question, answer_style):
 
     with st.chat_message("assistant"):
         response_placeholder = st.empty()
-        debug_placeholder = st.empty()
         # CallBack handler get_streamlit_cb
         st_callback = get_streamlit_cb(st.empty())
 
         start_time = time.time()
 
+        # Answers to identical questions with identical settings are served from the cache
+        answer_cache = get_answer_cache()
+        cache_key = AnswerCache.make_key(
+            question,
+            st.session_state.selected_country,
+            answer_style,
+            get_search_mode(),
+            st.session_state.selected_model,
+            st.session_state.selected_routing_model,
+            st.session_state.selected_grading_model,
+            st.session_state.selected_embedding_model,
+        )
+        cached_answer = answer_cache.get(cache_key)
+        metrics.record_answer_cache("answer", cached_answer is not None)
+        if cached_answer is not None:
+            print("Answer cache hit, replaying the cached answer")
+            telemetry.add_event("answer_cache", status="hit")
+        response_failed = False
+
+        # Otherwise, answers to similar questions are served from the semantic cache
+        semantic_scope = (
+            st.session_state.selected_country,
+            answer_style,
+            get_search_mode(),
+            st.session_state.selected_embedding_model,
+        )
+        question_embedding = None
+        if cached_answer is None:
+            cached_answer, question_embedding = lookup_semantic_cache(question, semantic_scope)
+            metrics.record_answer_cache("semantic_answer", cached_answer is not None)
+            if cached_answer is not None:
+                telemetry.add_event("semantic_answer_cache", status="hit")
+
         with st.spinner("Thinking..."):
-            inputs = {
-                "question": question,
-                "hybrid_search": st.session_state.hybrid_search,
-                "internet_search": st.session_state.internet_search,
-                "answer_style": answer_style
-            }
-            try:
-                # Attempt to stream response
-                for idx, chunk in enumerate(app.stream(inputs, config={"callbacks": [st_callback]})):
-                    debug_logs = output_buffer.getvalue()
-                    debug_placeholder.text_area(
-                        "Debug Logs", debug_logs, height=100, key=f"debug_logs_{idx}"
-                    )
-                    if "generate" in chunk and "generation" in chunk["generate"]:
-                        assistant_response += chunk["generate"]["generation"]
-                        styled_response = re.sub(
-                            r'\[(.*?)\]',
-                            r'<span class="reference">[\1]</span>',
-                            assistant_response
-                        )
-                        response_placeholder.markdown(
-                            f"**Assistant:** {styled_response}",
-                            unsafe_allow_html=True
-                        )
-            except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError) as ws_error:
-                # Log and silently handle known WebSocket errors without showing a modal.
-                print(f"WebSocket connection closed: {ws_error}")
-            except Exception as e:
-                error_str = str(e)
-                # Filter out non-critical errors (like "Bad message format") from showing in the UI.
-                if "Bad message format" in error_str:
-                    print(f"Non-critical error: {error_str}")
-                else:
-                    error_msg = f"Error generating response: {error_str}"
-                    response_placeholder.error(error_msg)
-                    st_callback.text = error_msg
-
-            # If no response was produced by streaming, attempt fallback using invoke
-            if not assistant_response.strip():
+            if cached_answer is not None:
+                assistant_response = cached_answer
+                stream_cached_answer(assistant_response, response_placeholder)
+            else:
+                inputs = {
+                    "question": question,
+                    "hybrid_search": st.session_state.hybrid_search,
+                    "internet_search": st.session_state.internet_search,
+                    "answer_style": answer_style,
+                    "started_at": start_time
+                }
+                # Nodes run in worker threads or on the event loop, where st.session_state
+                # is not available, so they get this question's runtime through the config
+                configurable = {"runtime": runtime_from_session_state()}
                 try:
-                    result = app.invoke(inputs)
-                    if "generate" in result and "generation" in result["generate"]:
-                        assistant_response = result["generate"]["generation"]
-                        styled_response = re.sub(
-                            r'\[(.*?)\]',
-                            r'<span class="reference">[\1]</span>',
-                            assistant_response
-                        )
-                        response_placeholder.markdown(
-                            f"**Assistant:** {styled_response}",
-                            unsafe_allow_html=True
-                        )
+                    # Attempt to stream response
+                    config = {"callbacks": [st_callback, telemetry], "configurable": configurable}
+                    if USE_ASYNC_WORKFLOW:
+                        chunks = iterate_async(app.astream(inputs, config=config))
                     else:
-                        raise ValueError("No generation found in result")
-                except Exception as fallback_error:
-                    fallback_str = str(fallback_error)
-                    if "Bad message format" in fallback_str:
-                        print(f"Non-critical fallback error: {fallback_str}")
+                        chunks = app.stream(inputs, config=config)
+                    for chunk in chunks:
+                        if "generate" in chunk and "generation" in chunk["generate"]:
+                            assistant_response += chunk["generate"]["generation"]
+                            styled_response = re.sub(
+                                r'\[(.*?)\]',
+                                r'<span class="reference">[\1]</span>',
+                                assistant_response
+                            )
+                            response_placeholder.markdown(
+                                f"**Assistant:** {styled_response}",
+                                unsafe_allow_html=True
+                            )
+                except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError) as ws_error:
+                    # Log and silently handle known WebSocket errors without showing a modal.
+                    print(f"WebSocket connection closed: {ws_error}")
+                except Exception as e:
+                    error_str = str(e)
+                    # Filter out non-critical errors (like "Bad message format") from showing in the UI.
+                    if "Bad message format" in error_str:
+                        print(f"Non-critical error: {error_str}")
                     else:
-                        print(f"Fallback also failed: {fallback_str}")
-                        if not assistant_response.strip():
-                            error_msg = ("Sorry, I encountered an error while generating a response. "
-                                         "Please try again or select a different model.")
-                            response_placeholder.error(error_msg)
-                            assistant_response = error_msg
+                        error_msg = f"Error generating response: {error_str}"
+                        response_placeholder.error(error_msg)
+                        st_callback.text = error_msg
+                        response_failed = True
+
+                # If no response was produced by streaming, attempt fallback using invoke
+                if not assistant_response.strip():
+                    telemetry.add_event("workflow_fallback", reason="streaming produced no answer")
+                    try:
+                        config = {"callbacks": [telemetry], "configurable": configurable}
+                        if USE_ASYNC_WORKFLOW:
+                            result = run_async(app.ainvoke(inputs, config=config))
+                        else:
+                            result = app.invoke(inputs, config=config)
+                        if "generate" in result and "generation" in result["generate"]:
+                            assistant_response = result["generate"]["generation"]
+                            styled_response = re.sub(
+                                r'\[(.*?)\]',
+                                r'<span class="reference">[\1]</span>',
+                                assistant_response
+                            )
+                            response_placeholder.markdown(
+                                f"**Assistant:** {styled_response}",
+                                unsafe_allow_html=True
+                            )
+                        else:
+                            raise ValueError("No generation found in result")
+                    except Exception as fallback_error:
+                        fallback_str = str(fallback_error)
+                        if "Bad message format" in fallback_str:
+                            print(f"Non-critical fallback error: {fallback_str}")
+                        else:
+                            print(f"Fallback also failed: {fallback_str}")
+                            if not assistant_response.strip():
+                                error_msg = ("Sorry, I encountered an error while generating a response. "
+                                             "Please try again or select a different model.")
+                                response_placeholder.error(error_msg)
+                                assistant_response = error_msg
+                                response_failed = True
+
 
         # End timer and calculate generation time
         end_time = time.time()
         generation_time = end_time - start_time
         st.session_state["last_generation_time"] = generation_time
 
+        # Only complete answers are cached, never errors from the workflow or
+        # answers generated without web results after a failed or late web search
+        if (cached_answer is None and assistant_response.strip() and not response_failed
+                and not assistant_response.startswith(("Error during generation", "Unable to process the request"))
+                and not web_search_degraded(list(telemetry.events))):
+            answer_cache.set(cache_key, assistant_response)
+            if question_embedding is not None:
+                ttl_seconds = (SEMANTIC_CACHE_WEB_TTL_SECONDS
+                               if get_search_mode() != "Reliable documents" else SEMANTIC_CACHE_TTL_SECONDS)
+                get_semantic_cache().set(semantic_scope, question_embedding, assistant_response,
+                                         ttl_seconds, generation_time)
+
+        telemetry.finish(cached=cached_answer is not None, failed=response_failed)
+        if response_failed:
+            metrics.record_error("app")
+        turn_telemetry = telemetry.summary()
+        write_log(turn_telemetry)
+
         # Optionally display the generation time if the timer is toggled on
         if st.session_state.get("show_timer", True):
             response_placeholder.markdown(
                 f"*Generation time: {generation_time:.2f} seconds*")
-
-        # Restore original stdout
-        sys.stdout = sys.__stdout__
+            show_telemetry(turn_telemetry)
 
     # 3) Update the assistant message with the final response
     st.session_state.messages[assistant_index]["content"] = assistant_response
+    st.session_state.messages[assistant_index]["telemetry"] = turn_telemetry
     st.session_state.followup_key += 1
 
 # -------------------- Country Selection Screen --------------------
@@ -514,6 +704,23 @@ with st.sidebar:
 
     # Toggle for displaying generation time
     st.checkbox("Show generation time", value=True, key="show_timer")
+
+    # Semantic answer cache counters (all sessions of this server)
+    semantic_cache_stats = get_semantic_cache().stats()
+    if semantic_cache_stats["lookups"]:
+        st.caption(
+            f"Semantic cache: {semantic_cache_stats['hit_rate']:.0%} hit rate "
+            f"({semantic_cache_stats['hits']}/{semantic_cache_stats['lookups']}), "
+            f"{semantic_cache_stats['seconds_saved']:.1f} s saved"
+        )
+
+    # Latency budget misses (all sessions of this server)
+    latency_metrics = get_latency_metrics()
+    if any(latency_metrics["deadline_misses"].values()):
+        misses = ", ".join(f"{stage}: {count}" for stage, count
+                           in latency_metrics["deadline_misses"].items() if count)
+        st.caption(f"Latency budget misses: {misses} "
+                   f"(total budget {latency_metrics['budget_seconds']['total']:.0f} s)")
     
     # RAG workflow initilizate.
     try:
@@ -529,7 +736,7 @@ with st.sidebar:
     except Exception as e:
         st.error("Error initializing model, continuing with previous model: " + str(e))
         # Initialize a fallback LLM for follow-up questions
-        st.session_state.llm = ChatOpenAI(model=model_default, temperature=0.5)
+        st.session_state.llm = get_shared_model("openai", model_default, temperature=0.5)
 
 # -------------------- Main Title & Introduction --------------------
 # flag_emoji = "🇫🇮" if st.session_state.selected_country == "Finland" else "🇪🇪"
@@ -806,6 +1013,8 @@ for message in st.session_state.messages:
                 f"**Assistant:** {styled_response}",
                 unsafe_allow_html=True
             )
+            if st.session_state.get("show_timer", True) and message.get("telemetry"):
+                show_telemetry(message["telemetry"])
 
 # Display the last generation time outside the chat messages if enabled.
 if st.session_state.get("show_timer", True) and "last_generation_time" in st.session_state:
@@ -0,0 +1,160 @@
+"""
+Run questions from a JSONL file through the agentic RAG workflow, without the
+Streamlit UI, e.g. for regression tests or to pre-warm the grade and web
+search caches overnight.
+
+Input: one JSON object per line. Only "question" is required:
+    {"id": "reg-1", "question": "How do I register a company?", "country": "Finland",
+     "answer_style": "Concise", "search_mode": "hybrid"}
+search_mode is "documents", "web" or "hybrid"; the model fields
+("answering_model", "routing_model", "grading_model", "embedding_model")
+default to the app's defaults. Lines without an "id" are identified by their
+line number.
+
+Output: one JSON object per question with the answer, the route, the ids of
+the retrieved chunks, the run time of every node, the token counts and the
+cache hit and fallback events (see telemetry.py). Results are appended as
+soon as each question finishes, so an interrupted run continues where it
+stopped when started again with the same output file.
+
+Usage:
+    python batch_runner.py questions.jsonl --output answers.jsonl --workers 8
+    python batch_runner.py questions.jsonl --output answers.jsonl --retry-errors
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+from agentic_rag import create_runtime, get_compiled_workflow
+from telemetry import TurnTelemetry
+
+# Same defaults as the Streamlit app
+default_settings = {
+    "country": "Finland",
+    "answer_style": "Concise",
+    "search_mode": "hybrid",
+    "answering_model": "gpt-4.1-2025-04-14",
+    "routing_model": "gpt-4.1-2025-04-14",
+    "grading_model": "gpt-4.1-2025-04-14",
+    "embedding_model": "text-embedding-3-large",
+}
+
+
+@lru_cache(maxsize=32)
+def get_batch_runtime(country, answering_model, embedding_model, routing_model, grading_model, answer_style):
+    """Questions with the same settings share one runtime (the nodes only read it)."""
+    return create_runtime(country, answering_model, embedding_model, routing_model,
+                          grading_model, answer_style)
+
+
+def read_questions(path):
+    """Return the input records, each with its settings filled in and an "id"."""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = {**default_settings, **json.loads(line)}
+            record["id"] = str(record.get("id", line_number))
+            records.append(record)
+    return records
+
+
+def read_finished_ids(path, retry_errors):
+    """Ids already in the output file (optionally without the ones that failed)."""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of an interrupted run
+                continue
+            if not (retry_errors and result.get("error")):
+                finished.add(result["id"])
+    return finished
+
+
+def ends_mid_line(path):
+    """True if an interrupted run left a partial last line in the file."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+def run_question(workflow_app, record):
+    """Run one question through the workflow and return its result record."""
+    telemetry = TurnTelemetry(question=record["question"])
+    start = time.time()
+    result = {"id": record["id"], "question": record["question"],
+              **{key: record[key] for key in default_settings}}
+    try:
+        runtime = get_batch_runtime(
+            record["country"], record["answering_model"], record["embedding_model"],
+            record["routing_model"], record["grading_model"], record["answer_style"])
+        inputs = {
+            "question": record["question"],
+            "hybrid_search": record["search_mode"] == "hybrid",
+            "internet_search": record["search_mode"] == "web",
+            "answer_style": record["answer_style"],
+            "started_at": start,
+        }
+        final_state = workflow_app.invoke(
+            inputs, config={"callbacks": [telemetry], "configurable": {"runtime": runtime}})
+        result["answer"] = final_state.get("generation", "")
+        result["error"] = None
+    except Exception as e:
+        result["answer"] = ""
+        result["error"] = str(e)
+    summary = telemetry.summary()
+    result["route"] = summary["route"]
+    result["retrieved_chunk_ids"] = telemetry.retrieved_chunk_ids
+    result["node_seconds"] = summary["node_seconds"]
+    result["tokens"] = summary["tokens"]
+    result["events"] = summary["events"]
+    result["total_seconds"] = round(time.time() - start, 4)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="JSONL file with one question per line")
+    parser.add_argument("--output", required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="Questions run at the same time")
+    parser.add_argument("--retry-errors", action="store_true",
+                        help="Run questions again whose earlier result was an error")
+    args = parser.parse_args()
+
+    records = read_questions(args.input)
+    finished = read_finished_ids(args.output, args.retry_errors)
+    pending = [record for record in records if record["id"] not in finished]
+    print(f"{len(records)} questions, {len(records) - len(pending)} already done, {len(pending)} to run")
+
+    workflow_app = get_compiled_workflow()
+    errors = 0
+    partial_line = ends_mid_line(args.output)
+    with open(args.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="batch") as executor:
+        if partial_line:
+            out.write("\n")
+        futures = [executor.submit(run_question, workflow_app, record) for record in pending]
+        for count, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            errors += bool(result["error"])
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            print(f"[{count}/{len(pending)}] {result['id']}: {result['route']} "
+                  f"in {result['total_seconds']:.1f}s{' (error)' if result['error'] else ''}")
+
+    print(f"Done, {errors} error(s). Results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+End-to-end latency benchmark of the RAG workflow for every search mode.
+
+Each mode runs its questions repeatedly through the compiled workflow (the
+same path as batch_runner.py) and reports p50/p95/p99 latency, throughput and
+a per-node breakdown (route_question, retrieve, grade_documents, websearch,
+generate and the hybrid search branches), so it shows which node dominates.
+
+Modes:
+    documents  Finland, "Reliable documents"
+    web        Finland, "Reliable web sources"
+    hybrid     Finland, "Reliable docs & web sources"
+    estonia    Estonia (always web search)
+    unrelated  off-topic questions that the router short-circuits
+
+Run it against the offline fake backends (see fake_backends.py) to compare
+commits without API costs or network noise; without them it measures the
+real providers. The grade and web search caches are disabled unless
+--with-caches is given, so repeated questions are not served from them.
+
+Usage:
+    SMART_GUIDE_FAKE_BACKENDS=1 python benchmark.py --runs 50 --concurrency 4 --output bench.json
+    SMART_GUIDE_FAKE_BACKENDS=1 python benchmark.py --baseline bench.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import agentic_rag
+from agentic_rag import get_compiled_workflow
+from batch_runner import default_settings, run_question
+from fake_backends import FAKE_BACKENDS_ENABLED
+
+# Country, search mode and questions of every benchmark mode
+benchmark_modes = {
+    "documents": ("Finland", "documents", [
+        "How do I register a company in Finland?",
+        "What are the requirements for a foreigner to start a business in Finland?",
+        "How do I apply for a startup grant from Business Finland?",
+    ]),
+    "web": ("Finland", "web", [
+        "How is VAT reported for a small business in Finland?",
+        "What insurance does a sole trader need in Finland?",
+        "How do I get a residence permit for an entrepreneur in Finland?",
+    ]),
+    "hybrid": ("Finland", "hybrid", [
+        "What taxes do entrepreneurs pay in Finland?",
+        "How do I hire my first employee in Finland?",
+        "What funding is available for startups in Finland?",
+    ]),
+    "estonia": ("Estonia", "hybrid", [
+        "How do I register a company in Estonia as an e-resident?",
+        "What is the corporate income tax in Estonia?",
+        "How do I open a business bank account in Estonia?",
+    ]),
+    "unrelated": ("Finland", "hybrid", [
+        "Can you give me a recipe for pancakes?",
+        "What will the weather be like tomorrow?",
+        "Who won the football match yesterday?",
+    ]),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def percentiles(values):
+    """p50/p95/p99, mean and max of a list of seconds."""
+    if len(values) > 1:
+        cuts = statistics.quantiles(values, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = values[0]
+    return {
+        "p50_s": round(p50, 4),
+        "p95_s": round(p95, 4),
+        "p99_s": round(p99, 4),
+        "mean_s": round(statistics.mean(values), 4),
+        "max_s": round(max(values), 4),
+    }
+
+
+def benchmark_mode(workflow_app, mode, runs, concurrency, settings):
+    """Run one mode `runs` times with `concurrency` questions at once and summarize it."""
+    country, search_mode, questions = benchmark_modes[mode]
+    records = [{**settings, "id": f"{mode}-{count}", "country": country, "search_mode": search_mode,
+                "question": questions[count % len(questions)]}
+               for count in range(runs)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="benchmark") as executor:
+        results = list(executor.map(lambda record: run_question(workflow_app, record), records))
+    wall_seconds = time.perf_counter() - start
+
+    succeeded = [result for result in results if not result["error"]]
+    for result in results:
+        if result["error"]:
+            print(f"Error in {result['id']}: {result['error']}")
+    summary = {
+        "country": country,
+        "search_mode": search_mode,
+        "runs": runs,
+        "errors": len(results) - len(succeeded),
+        "wall_s": round(wall_seconds, 4),
+        "throughput_per_s": round(len(succeeded) / wall_seconds, 4) if wall_seconds else 0.0,
+        "routes": dict(Counter(str(result["route"]) for result in results)),
+    }
+    if not succeeded:
+        return summary
+
+    summary["latency"] = percentiles([result["total_seconds"] for result in succeeded])
+    summary["tokens_per_question"] = {
+        kind: round(statistics.mean(result["tokens"][kind] for result in succeeded), 1)
+        for kind in ("prompt", "completion")
+    }
+    summary["events"] = dict(Counter(event["name"] for result in succeeded for event in result["events"]))
+    # A node missing from a run (e.g. grade_documents in web mode) is left out
+    # of that node's statistics rather than counted as zero
+    node_times = {}
+    for result in succeeded:
+        for node, seconds in result["node_seconds"].items():
+            node_times.setdefault(node, []).append(seconds)
+    total_node_seconds = sum(sum(times) for times in node_times.values()) or 1.0
+    summary["nodes"] = {
+        node: {**percentiles(times), "runs": len(times),
+               "share_of_node_time": round(sum(times) / total_node_seconds, 4)}
+        for node, times in sorted(node_times.items(), key=lambda item: -sum(item[1]))
+    }
+    return summary
+
+
+def print_comparison(report, baseline):
+    """Print the latency change of every mode against an earlier report."""
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'}:")
+    for mode, summary in report["modes"].items():
+        before = baseline.get("modes", {}).get(mode, {}).get("latency")
+        after = summary.get("latency")
+        if not before or not after:
+            continue
+        changes = ", ".join(
+            f"{key[:-2]} {after[key] - before[key]:+.3f}s ({(after[key] / before[key] - 1) * 100:+.0f}%)"
+            for key in ("p50_s", "p95_s", "p99_s") if before[key])
+        print(f"{mode:>10}: {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--modes", nargs="+", choices=list(benchmark_modes), default=list(benchmark_modes))
+    parser.add_argument("--runs", type=int, default=20, help="Questions per mode")
+    parser.add_argument("--concurrency", type=int, default=1, help="Questions run at the same time")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="Unmeasured runs per mode (load models, vector stores, router chains)")
+    parser.add_argument("--with-caches", action="store_true",
+                        help="Keep the grade and web search caches enabled")
+    parser.add_argument("--answering-model", default=default_settings["answering_model"])
+    parser.add_argument("--routing-model", default=default_settings["routing_model"])
+    parser.add_argument("--grading-model", default=default_settings["grading_model"])
+    parser.add_argument("--embedding-model", default=default_settings["embedding_model"])
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare the latencies with")
+    args = parser.parse_args()
+
+    if not args.with_caches:
+        agentic_rag.GRADE_CACHE_ENABLED = False
+        agentic_rag.WEB_CACHE_ENABLED = False
+
+    settings = {**default_settings,
+                "answering_model": args.answering_model,
+                "routing_model": args.routing_model,
+                "grading_model": args.grading_model,
+                "embedding_model": args.embedding_model}
+    workflow_app = get_compiled_workflow()
+
+    report = {
+        "git_commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "fake_backends": FAKE_BACKENDS_ENABLED,
+        "caches": args.with_caches,
+        "runs_per_mode": args.runs,
+        "concurrency": args.concurrency,
+        "models": {key: settings[key] for key in
+                   ("answering_model", "routing_model", "grading_model", "embedding_model")},
+        "modes": {},
+    }
+    for mode in args.modes:
+        if args.warmup:
+            benchmark_mode(workflow_app, mode, args.warmup, 1, settings)
+        summary = benchmark_mode(workflow_app, mode, args.runs, args.concurrency, settings)
+        report["modes"][mode] = summary
+        latency = summary.get("latency")
+        if latency:
+            slowest = next(iter(summary["nodes"]))
+            print(f"{mode:>10}: p50 {latency['p50_s']:.3f}s, p95 {latency['p95_s']:.3f}s, "
+                  f"p99 {latency['p99_s']:.3f}s, {summary['throughput_per_s']:.2f} questions/s, "
+                  f"slowest node {slowest}, {summary['errors']} error(s)")
+        else:
+            print(f"{mode:>10}: all {summary['runs']} runs failed")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
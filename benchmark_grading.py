@@ -0,0 +1,156 @@
+"""
+Compare the local FlashRank reranker ("rerank" grading mode) with the LLM
+grader chain (initialize_grader_chain) on chunks retrieved from the Finland
+vector store.
+
+For every question the same retrieved chunks are graded by both graders. The
+report contains the latency of each grader and the precision/recall of the
+reranker's verdicts against a reference: either hand labels (--labels) or,
+by default, the LLM grader's own verdicts.
+
+Usage:
+    python benchmark_grading.py
+    python benchmark_grading.py --labels labels.jsonl --output grading_report.json
+
+Labels file: one JSON object per line, e.g.
+    {"question": "How do I register a company in Finland?", "relevant_ids": ["<chunk id>", ...]}
+"""
+import argparse
+import json
+import statistics
+import time
+
+import agentic_rag
+from agentic_rag import create_runtime, get_reranker, grade_chunks_reranked, is_relevant
+from rag_cache import get_chunk_id
+
+default_questions = [
+    "How do I register a company in Finland?",
+    "What taxes do entrepreneurs pay in Finland?",
+    "What are the requirements for a foreigner to start a business in Finland?",
+    "How do I apply for a startup grant from Business Finland?",
+    "What insurance does a sole trader need in Finland?",
+    "How is VAT reported for a small business in Finland?",
+]
+
+
+def grade_with_llm(grader_chain, documents, question):
+    verdicts = []
+    for doc in documents:
+        try:
+            score = grader_chain.invoke({"documents": [doc], "question": question})
+            verdicts.append(is_relevant(score.binary_score))
+        except Exception as e:
+            print(f"Error grading chunk with the LLM grader: {e}")
+            verdicts.append(False)
+    return verdicts
+
+
+def precision_recall(predicted, reference):
+    true_positives = sum(1 for p, r in zip(predicted, reference) if p and r)
+    predicted_positives = sum(predicted)
+    reference_positives = sum(reference)
+    precision = true_positives / predicted_positives if predicted_positives else 1.0
+    recall = true_positives / reference_positives if reference_positives else 1.0
+    return precision, recall
+
+
+def latency_summary(latencies):
+    return {
+        "mean_s": round(statistics.mean(latencies), 4),
+        "p50_s": round(statistics.median(latencies), 4),
+        "max_s": round(max(latencies), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--questions", help="Text file with one question per line")
+    parser.add_argument("--labels", help="JSONL file with relevant chunk ids per question")
+    parser.add_argument("--grading-model", default="gpt-4.1-mini-2025-04-14")
+    parser.add_argument("--embedding-model", default="text-embedding-3-large")
+    parser.add_argument("--k", type=int, default=5, help="Chunks retrieved per question")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    questions = default_questions
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    labels = {}
+    if args.labels:
+        with open(args.labels, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    labels[entry["question"]] = set(entry["relevant_ids"])
+
+    # The grading model also stands in for the answering and routing models, which are not used
+    runtime = create_runtime("Finland", args.grading_model, args.embedding_model,
+                             args.grading_model, args.grading_model)
+    retriever = runtime.retriever.vectorstore.as_retriever(search_kwargs={"k": args.k})
+    grader_chain = runtime.doc_grader
+
+    # Load the reranker before timing it
+    get_reranker()
+
+    llm_latencies, rerank_latencies, results = [], [], []
+    llm_totals, rerank_totals = [], []
+    for question in questions:
+        documents = retriever.invoke(question)
+
+        start = time.perf_counter()
+        llm_verdicts = grade_with_llm(grader_chain, documents, question)
+        llm_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rerank_verdicts = grade_chunks_reranked(runtime, documents, question)
+        rerank_latencies.append(time.perf_counter() - start)
+
+        ids = [get_chunk_id(doc) for doc in documents]
+        if question in labels:
+            reference = [i in labels[question] for i in ids]
+            llm_totals.append(precision_recall(llm_verdicts, reference))
+        else:
+            reference = llm_verdicts
+        rerank_totals.append(precision_recall(rerank_verdicts, reference))
+
+        results.append({
+            "question": question,
+            "chunk_ids": ids,
+            "reference": reference,
+            "llm_grader": llm_verdicts,
+            "reranker": rerank_verdicts,
+            "llm_latency_s": round(llm_latencies[-1], 4),
+            "rerank_latency_s": round(rerank_latencies[-1], 4),
+        })
+        print(f"{question}: LLM {llm_latencies[-1]:.2f}s, reranker {rerank_latencies[-1]:.3f}s")
+
+    report = {
+        "grading_model": args.grading_model,
+        "reranker_model": agentic_rag.FLASHRANK_MODEL,
+        "rerank_top_n": agentic_rag.RERANK_TOP_N,
+        "rerank_score_threshold": agentic_rag.RERANK_SCORE_THRESHOLD,
+        "reference": "labels" if labels else "llm_grader",
+        "llm_grader": {"latency": latency_summary(llm_latencies)},
+        "reranker": {
+            "latency": latency_summary(rerank_latencies),
+            "precision": round(statistics.mean(p for p, _ in rerank_totals), 4),
+            "recall": round(statistics.mean(r for _, r in rerank_totals), 4),
+        },
+        "questions": results,
+    }
+    if llm_totals:
+        report["llm_grader"]["precision"] = round(statistics.mean(p for p, _ in llm_totals), 4)
+        report["llm_grader"]["recall"] = round(statistics.mean(r for _, r in llm_totals), 4)
+
+    print(json.dumps({key: value for key, value in report.items() if key != "questions"}, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
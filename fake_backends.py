@@ -0,0 +1,268 @@
+"""
+Offline stand-ins for the model and web search backends, so the whole graph
+can be run and load-tested without API keys or network access.
+
+- FakeChatModel: chat model with configurable latency and token rate. Replies
+  with scripted responses or, by default, with built-in replies: the router
+  says a question is business-related unless it contains an off-topic word,
+  graders keep about three out of four chunks (decided by a hash of the chunk,
+  so reruns give the same verdicts), and answers echo the question and the
+  start of the context.
+- HashEmbeddings: bag-of-words hash embeddings. 3072 dimensions by default,
+  the size of text-embedding-3-large, so the stored Chroma index can be
+  queried with them.
+- FakeOpenAI / FakeAsyncOpenAI: minimal Responses API whose output_text names
+  the first trusted domain of the request.
+
+Selected by agentic_rag.get_shared_model and get_openai_clients:
+SMART_GUIDE_FAKE_BACKENDS=1 replaces every model and the web search client,
+and model names starting with "fake-" select the fake chat or embedding
+model on their own. Timing is set with SMART_GUIDE_FAKE_LATENCY (seconds to
+the first token), SMART_GUIDE_FAKE_TOKENS_PER_SECOND and
+SMART_GUIDE_FAKE_WEB_LATENCY (seconds per web search).
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import (BaseChatModel,
+                                                        agenerate_from_stream,
+                                                        generate_from_stream)
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from pydantic import Field, PrivateAttr
+
+FAKE_BACKENDS_ENABLED = os.environ.get("SMART_GUIDE_FAKE_BACKENDS") == "1"
+FAKE_MODEL_PREFIX = "fake-"
+
+# Questions containing one of these words are routed as unrelated
+FAKE_OFF_TOPIC_WORDS = ("recipe", "weather", "football", "movie", "poem", "song")
+FAKE_ANSWER_WORDS = 120
+
+
+def is_fake_model(model_name):
+    return FAKE_BACKENDS_ENABLED or model_name.startswith(FAKE_MODEL_PREFIX)
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def stable_hash(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "little")
+
+
+def find_question(prompt):
+    """The question of a router, grader or answer prompt ("Question: ..." line)."""
+    matches = re.findall(r"[Qq]uestion:\s*(.+)", prompt)
+    return matches[-1].strip() if matches else prompt.strip()[:200]
+
+
+def is_off_topic(question):
+    return any(word in question.lower() for word in FAKE_OFF_TOPIC_WORDS)
+
+
+def fake_grade(text):
+    return "no" if stable_hash(text) % 4 == 0 else "yes"
+
+
+def fake_structured_reply(schema, prompt):
+    """Build the structured output of the router and graders for a prompt."""
+    question = find_question(prompt)
+    name = schema.__name__
+    if name == "RouteDecision":
+        related = not is_off_topic(question)
+        return schema.model_validate({
+            "business_related": related,
+            "other_country": False,
+            "suggested_route": "answer" if related else "unrelated",
+        })
+    if name == "GradeDocuments":
+        return schema.model_validate({"binary_score": fake_grade(prompt)})
+    if name == "BatchGradeDocuments":
+        # format_grading_batch writes "Chunk <n>:\n<text>" for every chunk
+        parts = re.split(r"Chunk (\d+):\n", prompt)[1:]
+        return schema.model_validate({"grades": [
+            {"chunk_id": int(number), "binary_score": fake_grade(text)}
+            for number, text in zip(parts[::2], parts[1::2])
+        ]})
+    # Other schemas get their field defaults
+    return schema.model_validate({})
+
+
+def fake_text_reply(prompt, answer_words):
+    """Reply to a yes/no router check, or answer by echoing the question and context."""
+    question = find_question(prompt)
+    if "OTHER THAN" in prompt:
+        return "no"
+    if "'yes' or 'no'" in prompt:
+        return "no" if is_off_topic(question) else "yes"
+    context = prompt.split("Context:", 1)[-1]
+    words = re.findall(r"\w+", context)[:answer_words]
+    return f"Offline answer to: {question}\n\n" + " ".join(words)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers locally after a configurable delay."""
+
+    model_name: str = "fake-chat"
+    # Scripted replies, returned in turn; empty for the built-in replies
+    responses: List[str] = Field(default_factory=list)
+    latency_seconds: float = Field(
+        default_factory=lambda: env_float("SMART_GUIDE_FAKE_LATENCY", "0.2"))
+    tokens_per_second: float = Field(
+        default_factory=lambda: env_float("SMART_GUIDE_FAKE_TOKENS_PER_SECOND", "50"))
+    answer_words: int = FAKE_ANSWER_WORDS
+    streaming: bool = True
+    _calls: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name}
+
+    def with_structured_output(self, schema, **kwargs):
+        return self.bind(structured_schema=schema) | RunnableLambda(
+            lambda message: schema.model_validate_json(message.content))
+
+    def _reply(self, messages, structured_schema=None):
+        if self.responses:
+            with self._lock:
+                reply = self.responses[self._calls % len(self.responses)]
+                self._calls += 1
+            return reply
+        prompt = "\n".join(m.content for m in messages if isinstance(m.content, str))
+        if structured_schema is not None:
+            return fake_structured_reply(structured_schema, prompt).model_dump_json()
+        return fake_text_reply(prompt, self.answer_words)
+
+    @staticmethod
+    def _usage(messages, reply):
+        """Token counts in the format of usage_metadata, estimated as words."""
+        input_tokens = sum(len(str(m.content).split()) for m in messages)
+        output_tokens = len(reply.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _token_seconds(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _generate(self, messages, stop=None, run_manager=None, structured_schema=None, **kwargs):
+        if self.streaming and structured_schema is None:
+            return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+        reply = self._reply(messages, structured_schema)
+        time.sleep(self.latency_seconds + len(reply.split()) * self._token_seconds())
+        message = AIMessage(content=reply, usage_metadata=self._usage(messages, reply))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, structured_schema=None, **kwargs):
+        if self.streaming and structured_schema is None:
+            return await agenerate_from_stream(self._astream(messages, stop, run_manager, **kwargs))
+        reply = self._reply(messages, structured_schema)
+        await asyncio.sleep(self.latency_seconds + len(reply.split()) * self._token_seconds())
+        message = AIMessage(content=reply, usage_metadata=self._usage(messages, reply))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, structured_schema=None, **kwargs):
+        reply = self._reply(messages, structured_schema)
+        time.sleep(self.latency_seconds)
+        tokens = re.findall(r"\s*\S+", reply)
+        for count, token in enumerate(tokens, start=1):
+            time.sleep(self._token_seconds())
+            # The last chunk carries the usage, like OpenAI's stream_usage
+            usage = self._usage(messages, reply) if count == len(tokens) else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, structured_schema=None, **kwargs):
+        reply = self._reply(messages, structured_schema)
+        await asyncio.sleep(self.latency_seconds)
+        tokens = re.findall(r"\s*\S+", reply)
+        for count, token in enumerate(tokens, start=1):
+            await asyncio.sleep(self._token_seconds())
+            usage = self._usage(messages, reply) if count == len(tokens) else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings: every word adds +-1 to a dimension
+    chosen by its hash. Texts sharing words get similar vectors.
+    """
+
+    def __init__(self, size=3072):
+        self.size = size
+
+    def embed_query(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            value = stable_hash(word)
+            vector[value % self.size] += 1.0 if value & (1 << 63) else -1.0
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            vector[0], norm = 1.0, 1.0
+        return (vector / norm).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def fake_web_search_text(request):
+    """output_text of a web search request built by get_web_search_request."""
+    query = request.get("input", "")
+    question = query.rsplit("\n\n", 1)[-1].strip()
+    domains = re.findall(r"exceptions:\s*(\S+?)[,\s]", query)
+    domain = domains[0] if domains else "example.com"
+    return (f"Offline web search results for: {question}\n\n"
+            f"According to [{domain}](https://{domain}/), this is a placeholder result "
+            f"returned without network access.")
+
+
+class FakeResponses:
+    def __init__(self, latency_seconds):
+        self.latency_seconds = latency_seconds
+
+    def create(self, **request):
+        time.sleep(self.latency_seconds)
+        return SimpleNamespace(output_text=fake_web_search_text(request))
+
+
+class FakeAsyncResponses(FakeResponses):
+    async def create(self, **request):
+        await asyncio.sleep(self.latency_seconds)
+        return SimpleNamespace(output_text=fake_web_search_text(request))
+
+
+class FakeOpenAI:
+    """Stands in for openai.OpenAI in web search (only client.responses.create)."""
+
+    def __init__(self, latency_seconds=None):
+        if latency_seconds is None:
+            latency_seconds = env_float("SMART_GUIDE_FAKE_WEB_LATENCY", "1.0")
+        self.responses = FakeResponses(latency_seconds)
+
+
+class FakeAsyncOpenAI:
+    """Stands in for openai.AsyncOpenAI in web search."""
+
+    def __init__(self, latency_seconds=None):
+        if latency_seconds is None:
+            latency_seconds = env_float("SMART_GUIDE_FAKE_WEB_LATENCY", "1.0")
+        self.responses = FakeAsyncResponses(latency_seconds)
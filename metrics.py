@@ -0,0 +1,121 @@
+"""
+Prometheus metrics of the RAG pipeline, shared by all sessions and requests
+of a process.
+
+agentic_rag reports into this module directly: node run times and errors
+from the graph_node wrapper, web search API latency from the fetch functions,
+and every record_event (cache lookups, grader verdicts, fallbacks, deadline
+misses). So the metrics cover the Streamlit app, the HTTP API and the batch
+scripts alike, without a callback on each run.
+
+Exposed on METRICS_PORT (start_metrics_server, used by the Streamlit app) and
+on /metrics of the HTTP API. With several API worker processes every worker
+has its own registry; scrape them individually or set up the
+prometheus_client multiprocess mode.
+
+Example alert on a generation latency regression:
+    histogram_quantile(0.95, sum by (le) (rate(smart_guide_node_seconds_bucket{node="generate"}[10m]))) > 20
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+# Seconds; covers local nodes (milliseconds) up to slow generations
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 45, 60, 90)
+
+node_seconds = Histogram(
+    "smart_guide_node_seconds", "Run time of the workflow nodes", ["node"], buckets=LATENCY_BUCKETS)
+node_errors = Counter(
+    "smart_guide_node_errors_total", "Workflow nodes that raised an exception", ["node"])
+routes = Counter(
+    "smart_guide_routes_total", "Questions by route_question outcome", ["route"])
+graded_chunks = Counter(
+    "smart_guide_graded_chunks_total", "Retrieved chunks by grader verdict", ["verdict"])
+web_search_seconds = Histogram(
+    "smart_guide_web_search_seconds", "Latency of the web search API calls", ["outcome"],
+    buckets=LATENCY_BUCKETS)
+cache_lookups = Counter(
+    "smart_guide_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+model_fallbacks = Counter(
+    "smart_guide_model_fallbacks_total", "Fallbacks to another model", ["kind", "from_model", "to_model"])
+errors = Counter(
+    "smart_guide_errors_total", "Errors that were handled and answered around", ["kind"])
+deadline_misses = Counter(
+    "smart_guide_deadline_misses_total", "Stages over their latency budget", ["stage"])
+
+_server_lock = threading.Lock()
+_server_started = False
+
+
+def observe_node(name, seconds, result=None, error=None):
+    """Record one run of a graph node (or of the route_question router)."""
+    node_seconds.labels(node=name).observe(seconds)
+    if error is not None:
+        node_errors.labels(node=name).inc()
+    elif name == "route_question" and isinstance(result, str):
+        routes.labels(route=result).inc()
+
+
+def observe_event(name, data):
+    """Count an event reported with agentic_rag.record_event."""
+    if name == "grade_cache":
+        cache_lookups.labels(cache="grade", result="hit").inc(data.get("hits", 0))
+        cache_lookups.labels(cache="grade", result="miss").inc(data.get("misses", 0))
+    elif name == "web_search_cache":
+        cache_lookups.labels(cache="web_search", result=data.get("status", "unknown")).inc()
+    elif name == "chunk_grades":
+        graded_chunks.labels(verdict="keep").inc(data.get("kept", 0))
+        graded_chunks.labels(verdict="drop").inc(data.get("dropped", 0))
+    elif name == "model_fallback":
+        model_fallbacks.labels(kind="generate", from_model=data.get("from_model", ""),
+                               to_model=data.get("to_model", "")).inc()
+    elif name == "router_fallback":
+        errors.labels(kind="router").inc()
+    elif name == "web_search_failed":
+        errors.labels(kind="web_search").inc()
+    elif name == "generation_failed":
+        errors.labels(kind="generation").inc()
+    elif name == "deadline_miss":
+        deadline_misses.labels(stage=data.get("stage", "unknown")).inc()
+
+
+def record_answer_cache(cache, hit):
+    """Count a lookup in one of the app's answer caches ("answer" or "semantic_answer")."""
+    cache_lookups.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def record_error(kind):
+    errors.labels(kind=kind).inc()
+
+
+@contextmanager
+def time_web_search():
+    """Measure one web search API call, labelled by whether it succeeded."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        web_search_seconds.labels(outcome="error").observe(time.perf_counter() - start)
+        raise
+    web_search_seconds.labels(outcome="ok").observe(time.perf_counter() - start)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics on `port`, once per process. Returns False if the port is taken."""
+    global _server_started
+    with _server_lock:
+        if _server_started:
+            return True
+        try:
+            start_http_server(port)
+        except OSError as e:
+            print(f"Could not start the metrics server on port {port}: {e}")
+            return False
+        _server_started = True
+        print(f"Serving Prometheus metrics on port {port}")
+        return True
@@ -0,0 +1,287 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Caches shared by all Streamlit sessions of a process. The SQLite-backed
+# caches also survive process restarts.
+
+
+def normalize_question(question):
+    """Lower-case the question, collapse whitespace and drop trailing punctuation."""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?!.")
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_chunk_id(doc):
+    """Stable identifier of a retrieved chunk (vector store id, else content hash)."""
+    return getattr(doc, "id", None) or hash_text(doc.page_content)[:16]
+
+
+class GradeCache:
+    """
+    Persistent cache of chunk relevance verdicts, keyed by the normalized
+    question, the chunk content and the grader model. Entries expire after
+    ttl_seconds, and the least recently used entries are evicted once the
+    cache holds more than max_entries.
+    """
+
+    def __init__(self, path, ttl_seconds, max_entries):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS grades ("
+                        "key TEXT PRIMARY KEY, relevant INTEGER NOT NULL, "
+                        "created_at REAL NOT NULL, last_access REAL NOT NULL)")
+                    conn.execute(
+                        "CREATE INDEX IF NOT EXISTS grades_last_access ON grades (last_access)")
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    @staticmethod
+    def make_key(question, document, model_name):
+        return hash_text("\n".join([
+            normalize_question(question),
+            hash_text(document.page_content),
+            model_name,
+        ]))
+
+    def get_many(self, question, documents, model_name):
+        """Return the cached verdict of each document, or None where there is none."""
+        keys = [self.make_key(question, doc, model_name) for doc in documents]
+        now = time.time()
+        conn = self._connect()
+        try:
+            placeholders = ",".join("?" * len(keys))
+            rows = dict(conn.execute(
+                f"SELECT key, relevant FROM grades WHERE key IN ({placeholders}) AND created_at > ?",
+                [*keys, now - self.ttl_seconds]).fetchall())
+            if rows:
+                conn.executemany("UPDATE grades SET last_access = ? WHERE key = ?",
+                                 [(now, key) for key in rows])
+                conn.commit()
+        finally:
+            conn.close()
+        return [bool(rows[key]) if key in rows else None for key in keys]
+
+    def set_many(self, question, documents, model_name, verdicts):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO grades (key, relevant, created_at, last_access) VALUES (?, ?, ?, ?)",
+                [(self.make_key(question, doc, model_name), int(verdict), now, now)
+                 for doc, verdict in zip(documents, verdicts)])
+            # Drop expired entries, then the least recently used ones above the limit
+            conn.execute("DELETE FROM grades WHERE created_at <= ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM grades WHERE key IN ("
+                "SELECT key FROM grades ORDER BY last_access ASC "
+                "LIMIT MAX(0, (SELECT COUNT(*) FROM grades) - ?))",
+                (self.max_entries,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class AnswerCache:
+    """
+    In-memory LRU cache of generated answers with a time-to-live. Thread-safe,
+    so one instance can be shared by all sessions of a process.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question, *scope):
+        return (normalize_question(question),) + tuple(scope)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            answer, created_at = entry
+            if time.time() - created_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return answer
+
+    def set(self, key, answer):
+        with self._lock:
+            self._entries[key] = (answer, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache matched by question similarity instead of exact text. Each
+    scope (e.g. country and answer style) has its own small vector index of
+    normalized question embeddings; a lookup returns the stored answer of the
+    most similar question when the cosine similarity reaches the threshold.
+    Each entry carries its own time-to-live. Thread-safe.
+    """
+
+    def __init__(self, threshold, max_entries_per_scope):
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        self._scopes = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def get(self, scope, embedding, lookup_seconds=0.0):
+        """Return (answer, similarity) of the best live match, or None."""
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            index = self._scopes.get(scope)
+            if not index:
+                return None
+            # Drop expired entries before matching
+            index[:] = [entry for entry in index if entry["expires_at"] > now]
+            if not index:
+                return None
+            similarities = np.stack([entry["vector"] for entry in index]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            entry = index[best]
+            self.hits += 1
+            self.seconds_saved += max(entry["generation_seconds"] - lookup_seconds, 0.0)
+            return entry["answer"], float(similarities[best])
+
+    def set(self, scope, embedding, answer, ttl_seconds, generation_seconds):
+        with self._lock:
+            index = self._scopes.setdefault(scope, [])
+            index.append({
+                "vector": self._normalize(embedding),
+                "answer": answer,
+                "expires_at": time.time() + ttl_seconds,
+                "generation_seconds": generation_seconds,
+            })
+            # Oldest entries are evicted first
+            del index[:-self.max_entries_per_scope]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "seconds_saved": self.seconds_saved,
+            }
+
+
+class WebSearchCache:
+    """
+    Persistent cache of web search result texts. get() returns the text with
+    its age, so callers can decide between fresh, stale-but-usable and expired
+    results. Also tracks which keys are being refreshed, so one stale entry
+    triggers only one background refresh.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._refreshing = set()
+
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS web_results ("
+                        "key TEXT PRIMARY KEY, output_text TEXT NOT NULL, created_at REAL NOT NULL)")
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    @staticmethod
+    def make_key(country_code, domains, question):
+        domains_hash = hash_text(",".join(sorted(set(domains))))
+        return hash_text("\n".join([country_code, domains_hash, normalize_question(question)]))
+
+    def get(self, key):
+        """Return (output_text, age in seconds), or None."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT output_text, created_at FROM web_results WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return row[0], time.time() - row[1]
+
+    def set(self, key, output_text):
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO web_results (key, output_text, created_at) VALUES (?, ?, ?)",
+                (key, output_text, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete_older_than(self, max_age_seconds):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM web_results WHERE created_at < ?",
+                         (time.time() - max_age_seconds,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def begin_refresh(self, key):
+        """Return True if the caller should refresh the key (no refresh running yet)."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
@@ -0,0 +1,193 @@
+"""
+Per-question telemetry of the RAG workflow, collected with a LangChain
+callback handler instead of reading the print output.
+
+TurnTelemetry records for one question (a chat turn):
+- every graph node: start and end time relative to the question's start
+- every model call: node, model name, duration, time to the first streamed
+  token, prompt and completion tokens (when the provider reports them)
+- events the nodes report with agentic_rag.record_event (grade and web search
+  cache hits, fallback models, router fallbacks, deadline misses) and the
+  ones the caller adds itself (e.g. answer cache hits)
+
+summary() returns it all as one JSON-serializable dict; write_log() appends
+it as one line to the JSON log at TELEMETRY_LOG_PATH.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+from langchain_core.callbacks.base import BaseCallbackHandler
+
+from rag_cache import get_chunk_id
+
+TELEMETRY_LOG_PATH = os.environ.get("SMART_GUIDE_TELEMETRY_LOG", "data/logs/telemetry.jsonl")
+
+# Graph nodes (and the entry router) that are timed
+timed_nodes = {"route_question", "retrieve", "grade_documents", "websearch", "generate",
+               "hybrid_search", "vector_branch", "web_branch", "hybrid_join", "unrelated"}
+
+_log_lock = threading.Lock()
+
+
+def token_usage(response):
+    """(prompt tokens, completion tokens) of an LLMResult, or (None, None) if not reported."""
+    prompt_tokens = completion_tokens = None
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens = (prompt_tokens or 0) + usage.get("input_tokens", 0)
+                completion_tokens = (completion_tokens or 0) + usage.get("output_tokens", 0)
+    if prompt_tokens is None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+    return prompt_tokens, completion_tokens
+
+
+class TurnTelemetry(BaseCallbackHandler):
+    """Callback handler collecting the telemetry of one question. Thread-safe."""
+
+    # Cheap bookkeeping only, so async runs call it directly instead of in a thread
+    run_inline = True
+
+    def __init__(self, question=None, **attributes):
+        self.turn_id = uuid.uuid4().hex
+        self.question = question
+        # Settings of the turn (country, models, search mode, ...)
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.total_seconds = None
+        self.nodes = []
+        self.llm_calls = []
+        self.events = []
+        self.route = None
+        self.retrieved_chunk_ids = []
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def _elapsed(self):
+        return round(time.perf_counter() - self._start, 4)
+
+    def _finish_run(self, run_id, error=None):
+        with self._lock:
+            record = self._open.pop(run_id, None)
+            if record is None:
+                return None
+            record["end_s"] = self._elapsed()
+            record["seconds"] = round(record["end_s"] - record["start_s"], 4)
+            if error is not None:
+                record["error"] = str(error)
+            (self.nodes if record["kind"] == "node" else self.llm_calls).append(record)
+            return record
+
+    # Graph nodes
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, name=None, **kwargs):
+        with self._lock:
+            # A graph node runs its RunnableLambda as a child run of the same name
+            parent = self._open.get(parent_run_id)
+            if name in timed_nodes and not (parent and parent.get("name") == name):
+                self._open[run_id] = {"kind": "node", "name": name, "start_s": self._elapsed()}
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        record = self._finish_run(run_id)
+        if record is not None and record["name"] == "route_question":
+            self.route = outputs
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish_run(run_id, error)
+
+    # Model calls
+
+    def _start_llm(self, run_id, metadata, invocation_params):
+        metadata = metadata or {}
+        invocation_params = invocation_params or {}
+        with self._lock:
+            self._open[run_id] = {
+                "kind": "llm",
+                "node": metadata.get("langgraph_node"),
+                "model": (metadata.get("ls_model_name") or invocation_params.get("model_name")
+                          or invocation_params.get("model")),
+                "start_s": self._elapsed(),
+            }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, invocation_params=None, **kwargs):
+        self._start_llm(run_id, metadata, invocation_params)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, invocation_params=None, **kwargs):
+        self._start_llm(run_id, metadata, invocation_params)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            record = self._open.get(run_id)
+            if record is not None and "first_token_s" not in record:
+                record["first_token_s"] = round(self._elapsed() - record["start_s"], 4)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens, completion_tokens = token_usage(response)
+        record = self._finish_run(run_id)
+        if record is not None:
+            record["prompt_tokens"] = prompt_tokens
+            record["completion_tokens"] = completion_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish_run(run_id, error)
+
+    # Retrieval and events
+
+    def on_retriever_end(self, documents, **kwargs):
+        with self._lock:
+            self.retrieved_chunk_ids.extend(get_chunk_id(doc) for doc in documents)
+
+    def on_custom_event(self, name, data, *, run_id, metadata=None, **kwargs):
+        self.add_event(name, node=(metadata or {}).get("langgraph_node"), **(data or {}))
+
+    def add_event(self, name, **data):
+        """Record an event, e.g. a cache hit or a fallback."""
+        with self._lock:
+            self.events.append({"name": name, "at_s": self._elapsed(), **data})
+
+    def finish(self, **attributes):
+        """Stop the clock of the turn and add final attributes (e.g. whether it failed)."""
+        self.total_seconds = self._elapsed()
+        self.attributes.update(attributes)
+
+    def summary(self):
+        with self._lock:
+            node_seconds = {}
+            for record in self.nodes:
+                # Nodes that run more than once (retries) are summed
+                node_seconds[record["name"]] = round(node_seconds.get(record["name"], 0.0) + record["seconds"], 4)
+            return {
+                "turn_id": self.turn_id,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started_at)),
+                "question": self.question,
+                **self.attributes,
+                "total_seconds": self.total_seconds if self.total_seconds is not None else self._elapsed(),
+                "route": self.route,
+                "node_seconds": node_seconds,
+                "nodes": list(self.nodes),
+                "llm_calls": list(self.llm_calls),
+                "tokens": {
+                    "prompt": sum(call.get("prompt_tokens") or 0 for call in self.llm_calls),
+                    "completion": sum(call.get("completion_tokens") or 0 for call in self.llm_calls),
+                },
+                "fallback_used": any(event["name"] == "model_fallback" for event in self.events),
+                "events": list(self.events),
+            }
+
+
+def write_log(summary, path=TELEMETRY_LOG_PATH):
+    """Append one telemetry summary to the JSON log (one object per line)."""
+    try:
+        with _log_lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary, ensure_ascii=False, default=str) + "\n")
+    except Exception as e:
+        print(f"Error writing the telemetry log: {e}")